@@ -0,0 +1,187 @@
+import argparse
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ctb2strava
+
+
+ROUTE_TYPES = ('SPORT_CLIMBING', 'BOULDER', 'SPEED_CLIMBING', 'MULTI_PITCH', 'TRAD_CLIMBING', 'ICE_CLIMBING', 'DEEP_WATER_SOLO', 'FREE_SOLO')
+
+def generate_route(rng, route_id, session_id, ascend_order, route_type):
+    route = {
+        'route_id': route_id,
+        'session_id': session_id,
+        'ascend_order': ascend_order,
+        'route_type': route_type,
+        'route_name': rng.choice(["", "", f"Route {route_id}"]),
+        'comment': rng.choice(["", "", "", "Nice one"]),
+        'ascend_height': rng.choice([0, 12, 15, 18, 25]),
+        'top_rope': rng.randint(0, 2 if route_type == 'MULTI_PITCH' else 1),
+        'speed_type': 1,
+        'speed_time': 0,
+        'style_id': rng.randint(1, 10),
+        'grade_id': rng.choice(ctb2strava.GRADE_SYSTEM_IDS['french']),
+        'original_grade_system': rng.choice([None, 'French', 'UIAA', 'YDS'])
+    }
+
+    if route_type == 'BOULDER':
+        route['style_id'] = rng.randint(100, 103)
+        route['grade_id'] = rng.choice(ctb2strava.GRADE_SYSTEM_IDS['fontainebleau'])
+        route['original_grade_system'] = rng.choice([None, 'Fontainebleau', 'V-Scale'])
+        route['ascend_height'] = 0
+    elif route_type == 'SPEED_CLIMBING':
+        route['speed_type'] = rng.randint(0, 1)
+        route['speed_time'] = rng.randint(5000, 30000)
+    elif route_type == 'ICE_CLIMBING':
+        route['grade_id'] = rng.choice(ctb2strava.GRADE_SYSTEM_IDS['wi-scale'])
+        route['original_grade_system'] = rng.choice([None, 'WI-Scale'])
+
+    return route
+
+def generate_backup(sessions=500, routes_per_session=10, locations=20, route_types=ROUTE_TYPES, session_hours=2, seed=0):
+    # Synthetic Climbing Tracker backup with the fields read by ctb2strava
+    rng = random.Random(seed)
+    backup = {'sessions': [], 'routes': [], 'locations': []}
+
+    for location_id in range(1, locations + 1):
+        backup['locations'].append({
+            'location_id': location_id,
+            'location_name': f"Location {location_id}",
+            'location_outdoor': rng.randint(0, 1),
+            'latitude': rng.uniform(43.5, 47.5),
+            'longitude': rng.uniform(5.5, 10.5)
+        })
+
+    start = datetime(2015, 1, 1, 18)
+    route_id = 1
+    for session_id in range(1, sessions + 1):
+        time_start = start + timedelta(days=session_id, minutes=rng.randint(-120, 120))
+        time_end = time_start + timedelta(hours=session_hours, seconds=rng.randint(0, 1800))
+        backup['sessions'].append({
+            'session_id': session_id,
+            'location_id': rng.randint(1, locations),
+            'time_start': time_start.isoformat(timespec='milliseconds'),
+            'time_end': time_end.isoformat(timespec='milliseconds'),
+            'session_comment': rng.choice(["", "", "Good session"])
+        })
+        for ascend_order in range(routes_per_session):
+            backup['routes'].append(generate_route(rng, route_id, session_id, ascend_order, rng.choice(route_types)))
+            route_id += 1
+
+    rng.shuffle(backup['sessions'])
+    return backup
+
+def measure(results, stage, function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        timings.append(time.perf_counter() - start)
+    results[stage] = {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'max': max(timings),
+        'timings': timings
+    }
+    print(f"{stage:<32} min {min(timings) * 1000:10.2f} ms  median {statistics.median(timings) * 1000:10.2f} ms")
+    return value
+
+def get_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    # No network: constant elevation, and timezones and rings resolved once before timing
+    ctb2strava.fetch_elevations = lambda points, dataset: [args.elevation] * len(points)
+    ctb2strava.open_cache(':memory:')
+
+    backup_data = generate_backup(args.sessions, args.routes_per_session, args.locations, args.route_types, args.session_hours, args.seed)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        ctb_file = os.path.join(directory, 'ctb.json')
+        with open(ctb_file, 'w') as file:
+            json.dump(backup_data, file)
+        last_export = min(session['time_start'] for session in backup_data['sessions'])
+
+        def load():
+            with open(ctb_file) as file:
+                return ctb2strava.index_backup(json.load(file))
+
+        backup = measure(results, 'load', load, args.repeat)
+        measure(results, 'load_stream', lambda: ctb2strava.index_backup(ctb2strava.stream_backup(ctb_file, last_export)), args.repeat)
+
+    sessions = measure(results, 'select_sessions', lambda: ctb2strava.get_new_sessions(backup, last_export), args.repeat)
+    routes = [ctb2strava.get_routes(backup, session) for session in sessions]
+    locations = [ctb2strava.get_location(backup, session) for session in sessions]
+
+    measure(results, 'description', lambda: [ctb2strava.get_description(session, session_routes) for session, session_routes in zip(sessions, routes)], args.repeat)
+
+    ctb2strava.prefetch_elevations([(location['latitude'], location['longitude']) for location in locations])
+    for location in locations:
+        ctb2strava.get_zone_info(location)
+        ctb2strava.get_ring(location['latitude'], location['longitude'])
+
+    track_sessions = sessions[:args.track_sessions]
+    track_arguments = []
+    for session, session_routes, location in zip(track_sessions, routes, locations):
+        zone_info = ctb2strava.get_zone_info(location)
+        track_arguments.append((
+            location['latitude'],
+            location['longitude'],
+            datetime.fromisoformat(session['time_start']).replace(tzinfo=zone_info).astimezone(timezone.utc),
+            datetime.fromisoformat(session['time_end']).replace(tzinfo=zone_info).astimezone(timezone.utc),
+            args.elevation,
+            [ctb2strava.get_route_height(route) for route in session_routes]
+        ))
+
+    tracks = None
+    for engine in args.engines:
+        engine_tracks = measure(results, f'track_{engine}', lambda: [list(ctb2strava.TRACK_ENGINES[engine](*arguments)) for arguments in track_arguments], args.repeat)
+        tracks = tracks or engine_tracks
+
+    measure(results, 'serialize', lambda: [ctb2strava.write_gpx(BytesIO(), "Title", "Description", 'RockClimbing', session_tracks) for session_tracks in tracks], args.repeat)
+    measure(results, 'gpx_file', lambda: [ctb2strava.get_gpx_file(backup, session, args.gzip_level).close() for session in track_sessions], args.repeat)
+
+    return {
+        'version': get_version(),
+        'python': platform.python_version(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'parameters': {name: value for name, value in vars(args).items() if name != 'output'},
+        'stages': results
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time each stage of ctb2strava on a synthetic Climbing Tracker backup')
+    parser.add_argument('--sessions', type=int, default=500, help='Number of sessions')
+    parser.add_argument('--routes-per-session', type=int, default=10, help='Number of routes per session')
+    parser.add_argument('--locations', type=int, default=20, help='Number of locations')
+    parser.add_argument('--route-types', nargs='+', choices=ROUTE_TYPES, default=ROUTE_TYPES, help='Route types to generate')
+    parser.add_argument('--session-hours', type=float, default=2, help='Duration of the sessions')
+    parser.add_argument('--track-sessions', type=int, default=20, help='Number of sessions used for the track and GPX stages')
+    parser.add_argument('--engines', nargs='+', choices=ctb2strava.TRACK_ENGINES, default=list(ctb2strava.TRACK_ENGINES), help='Track engines to time')
+    parser.add_argument('--gzip-level', type=int, default=6, help='Compression level of the gpx_file stage')
+    parser.add_argument('--elevation', type=float, default=432.5, help='Elevation returned by the stubbed elevation API')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each stage')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic backup')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file receiving the results')
+
+    args = parser.parse_args()
+    report = run(args)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
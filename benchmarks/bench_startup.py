@@ -0,0 +1,81 @@
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_stages import generate_backup, get_version
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ctb2strava.py')
+HEAVY_MODULES = ('numpy', 'requests', 'urllib3', 'geopy', 'timezonefinder', 'gpx2strava')
+
+def measure(results, stage, command, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, capture_output=True)
+        timings.append(time.perf_counter() - start)
+    results[stage] = {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'max': max(timings),
+        'timings': timings
+    }
+    print(f"{stage:<32} min {min(timings) * 1000:10.2f} ms  median {statistics.median(timings) * 1000:10.2f} ms")
+
+def get_imported_modules(command):
+    # Top-level packages listed by -X importtime
+    output = subprocess.run([command[0], '-X', 'importtime', *command[1:]], check=True, capture_output=True, text=True).stderr
+    return sorted({line.rsplit('|', 1)[1].strip().split('.')[0] for line in output.splitlines() if line.startswith('import time:') and '|' in line})
+
+def run(args):
+    backup = generate_backup(args.sessions, args.routes_per_session, args.locations, seed=args.seed)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        # No session after last_export: the run ends at "No session found"
+        config_file = os.path.join(directory, 'config.json')
+        with open(config_file, 'w') as file:
+            json.dump({'client_id': 0, 'client_secret': '', 'refresh_token': '', 'last_export': max(session['time_start'] for session in backup['sessions'])}, file)
+        ctb_file = os.path.join(directory, 'ctb.json')
+        with open(ctb_file, 'w') as file:
+            json.dump(backup, file)
+
+        command = [sys.executable, SCRIPT, config_file, ctb_file, '--cache', os.path.join(directory, 'ctb2strava.sqlite')]
+        measure(results, 'interpreter', [sys.executable, '-c', 'pass'], args.repeat)
+        measure(results, 'import', [sys.executable, '-c', f'import sys; sys.path.insert(0, {os.path.dirname(SCRIPT)!r}); import ctb2strava'], args.repeat)
+        measure(results, 'no_op', command, args.repeat)
+        measure(results, 'no_op_stream', command + ['--stream'], args.repeat)
+        heavy_modules = [module for module in get_imported_modules(command) if module in HEAVY_MODULES]
+
+    print(f"Heavy modules imported by a no-op run: {', '.join(heavy_modules) or 'none'}")
+    return {
+        'version': get_version(),
+        'python': platform.python_version(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'parameters': {name: value for name, value in vars(args).items() if name != 'output'},
+        'stages': results,
+        'heavy_modules': heavy_modules
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the startup of a ctb2strava run without any session to export')
+    parser.add_argument('--sessions', type=int, default=500, help='Number of sessions of the synthetic backup')
+    parser.add_argument('--routes-per-session', type=int, default=10, help='Number of routes per session')
+    parser.add_argument('--locations', type=int, default=20, help='Number of locations')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of runs of each stage')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic backup')
+    parser.add_argument('--output', default='benchmark_startup.json', help='JSON file receiving the results')
+
+    args = parser.parse_args()
+    report = run(args)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
@@ -1,740 +1,1033 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from timezonefinder import TimezoneFinder
+import errno
+from functools import lru_cache
+import gzip
+from io import BytesIO
+from itertools import islice
+import json
+import math
+import os
+import re
+import sqlite3
+from tempfile import SpooledTemporaryFile
+import threading
+import time
+from uuid import uuid4
+import zlib
 from zoneinfo import ZoneInfo
-from geopy.distance import geodesic
-import requests
-from gpx2strava import gpx2strava, utils
+from urllib.parse import urlsplit
 
 
-def get_new_sessions(ctb, last_export):
-    return sorted(filter(lambda x: x['time_start'] > last_export, ctb['sessions']), key=lambda x: x['time_start'])
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.timings = {}
+        self.sessions = {}
+        self.counters = {}
 
-def get_location(ctb, session):
-    return next(filter(lambda x: x['location_id'] == session['location_id'], ctb['locations']), None)
+    @contextmanager
+    def session(self, session):
+        # Timings recorded by this thread inside the block are also attributed to the session
+        previous = getattr(self.local, 'session', None)
+        self.local.session = session['session_id']
+        try:
+            yield
+        finally:
+            self.local.session = previous
 
-def get_routes(ctb, session):
-    return sorted(filter(lambda x: x['session_id'] == session['session_id'], ctb['routes']), key=lambda x: x['ascend_order'])
+    def record(self, stage, seconds):
+        session_id = getattr(self.local, 'session', None)
+        with self.lock:
+            self.timings.setdefault(stage, []).append(seconds)
+            if session_id is not None:
+                session_timings = self.sessions.setdefault(session_id, {})
+                session_timings[stage] = session_timings.get(stage, 0) + seconds
 
-def get_route_grade_name(route):
-    if route['route_type'] == 'SPEED_CLIMBING' and route['speed_type'] == 0:
-        return "Std."
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
 
-    grade = {
-        5: {
-            "wi-scale": "WI-1"
-        },
-        10: {
-            "wi-scale": "WI-2"
-        },
-        15: {
-            "wi-scale": "WI-3"
-        },
-        20: {
-            "wi-scale": "WI-4"
-        },
-        25: {
-            "wi-scale": "WI-5"
-        },
-        30: {
-            "wi-scale": "WI-6"
-        },
-        35: {
-            "wi-scale": "WI-7"
-        },
-        40: {
-            "wi-scale": "WI-8"
-        },
-        100: {
-            "uiaa": "1",
-            "french": "1",
-            "yds": "5.0",
-            "aus": "10"
-        },
-        150: {
-            "uiaa": "1",
-            "french": "1/2",
-            "yds": "5.0/5.1",
-            "aus": "10/11"
-        },
-        200: {
-            "uiaa": "2",
-            "french": "2",
-            "yds": "5.1",
-            "aus": "11"
-        },
-        250: {
-            "uiaa": "2+",
-            "french": "2/3",
-            "yds": "5.1/5.2",
-            "aus": "11/12"
-        },
-        275: {
-            "uiaa": "3-",
-            "french": "2/3",
-            "yds": "5.1/5.2",
-            "aus": "11/12"
-        },
-        300: {
-            "uiaa": "3",
-            "french": "3",
-            "yds": "5.2",
-            "aus": "12"
-        },
-        320: {
-            "uiaa": "3/3+",
-            "french": "3",
-            "yds": "5.2",
-            "aus": "12"
-        },
-        350: {
-            "uiaa": "3+",
-            "french": "3/4a",
-            "yds": "5.2/5.3",
-            "aus": "12/13"
-        },
-        365: {
-            "uiaa": "3+/4-",
-            "french": "3/4a",
-            "yds": "5.2/5.3",
-            "aus": "12/13"
-        },
-        375: {
-            "uiaa": "4-",
-            "french": "4a",
-            "yds": "5.3",
-            "aus": "13"
-        },
-        385: {
-            "uiaa": "4-/4",
-            "french": "4a/4b",
-            "yds": "5.3",
-            "aus": "13"
-        },
-        400: {
-            "uiaa": "4",
-            "french": "4b",
-            "yds": "5.3",
-            "aus": "13"
-        },
-        425: {
-            "uiaa": "4/4+",
-            "french": "4b/4c",
-            "yds": "5.3/5.4",
-            "aus": "13/14"
-        },
-        450: {
-            "uiaa": "4+",
-            "french": "4c",
-            "yds": "5.4",
-            "aus": "14"
-        },
-        475: {
-            "uiaa": "4+/5-",
-            "french": "4c/5a",
-            "yds": "5.4/5.5",
-            "aus": "14/15"
-        },
-        500: {
-            "uiaa": "5-",
-            "french": "5a",
-            "yds": "5.5",
-            "aus": "14/15"
-        },
-        550: {
-            "uiaa": "5-/5",
-            "french": "5a/+",
-            "yds": "5.5/5.6",
-            "aus": "14/15"
-        },
-        600: {
-            "uiaa": "5",
-            "french": "5a+",
-            "yds": "5.6",
-            "aus": "15"
-        },
-        650: {
-            "uiaa": "5/5+",
-            "french": "5a+/5b",
-            "yds": "5.6/5.7",
-            "aus": "15/16"
-        },
-        700: {
-            "uiaa": "5+",
-            "french": "5b",
-            "yds": "5.7",
-            "aus": "16"
-        },
-        750: {
-            "uiaa": "5+/6-",
-            "french": "5b/+",
-            "yds": "5.7/5.8",
-            "aus": "16/17"
-        },
-        800: {
-            "uiaa": "6-",
-            "french": "5b+",
-            "yds": "5.8",
-            "aus": "17"
-        },
-        850: {
-            "uiaa": "6-/6",
-            "french": "5b+/5c",
-            "yds": "5.8/5.9",
-            "aus": "17/18"
-        },
-        900: {
-            "uiaa": "6",
-            "french": "5c",
-            "yds": "5.9",
-            "aus": "18"
-        },
-        920: {
-            "uiaa": "6",
-            "french": "5c/+",
-            "yds": "5.9",
-            "aus": "18"
-        },
-        940: {
-            "uiaa": "6/6+",
-            "french": "5c+",
-            "yds": "5.9/5.10a,",
-            "aus": "18/19"
-        },
-        950: {
-            "uiaa": "6/6+",
-            "french": "5c+/6a",
-            "yds": "5.9/5.10a",
-            "aus": "18/19"
-        },
-        1000: {
-            "uiaa": "6+",
-            "french": "6a",
-            "yds": "5.10a",
-            "aus": "19"
-        },
-        1050: {
-            "uiaa": "6+/7-",
-            "french": "6a/+",
-            "yds": "5.10a/5.10b",
-            "aus": "19/20"
-        },
-        1100: {
-            "uiaa": "7-",
-            "french": "6a+",
-            "yds": "5.10b",
-            "aus": "20"
-        },
-        1150: {
-            "uiaa": "7-/7",
-            "french": "6a+/6b",
-            "yds": "5.10b/5.10c",
-            "aus": "20/21"
-        },
-        1200: {
-            "uiaa": "7",
-            "french": "6b",
-            "yds": "5.10c",
-            "aus": "21"
-        },
-        1250: {
-            "uiaa": "7/7+",
-            "french": "6b/+",
-            "yds": "5.10c/5.10d",
-            "aus": "21/22"
-        },
-        1300: {
-            "uiaa": "7+",
-            "french": "6b+",
-            "yds": "5.10d",
-            "aus": "22"
-        },
-        1350: {
-            "uiaa": "7+",
-            "french": "6b+/6c",
-            "yds": "5.10d/5.11a",
-            "aus": "22"
-        },
-        1400: {
-            "uiaa": "7+/8-",
-            "french": "6c",
-            "yds": "5.11a",
-            "aus": "22/23"
-        },
-        1450: {
-            "uiaa": "7+/8-",
-            "french": "6c/+",
-            "yds": "5.11a/5.11b",
-            "aus": "22/23"
-        },
-        1500: {
-            "uiaa": "8-",
-            "french": "6c+",
-            "yds": "5.11b",
-            "aus": "23"
-        },
-        1550: {
-            "uiaa": "8-/8",
-            "french": "6c+/7a",
-            "yds": "5.11b/5.11c",
-            "aus": "23/24"
-        },
-        1600: {
-            "uiaa": "8",
-            "french": "7a",
-            "yds": "5.11c",
-            "aus": "24"
-        },
-        1650: {
-            "uiaa": "8/8+",
-            "french": "7a/+",
-            "yds": "5.11c/5.11d",
-            "aus": "24/25"
-        },
-        1700: {
-            "uiaa": "8+",
-            "french": "7a+",
-            "yds": "5.11d",
-            "aus": "25"
-        },
-        1750: {
-            "uiaa": "8+",
-            "french": "7a+/7b",
-            "yds": "5.11d/5.12a",
-            "aus": "25"
-        },
-        1800: {
-            "uiaa": "8+/9-",
-            "french": "7b",
-            "yds": "5.12a",
-            "aus": "25/26"
-        },
-        1850: {
-            "uiaa": "8+/9-",
-            "french": "7b/+",
-            "yds": "5.12a/5.12b",
-            "aus": "25/26"
-        },
-        1900: {
-            "uiaa": "9-",
-            "french": "7b+",
-            "yds": "5.12b",
-            "aus": "26"
-        },
-        1950: {
-            "uiaa": "9-/9",
-            "french": "7b+/7c",
-            "yds": "5.12b/5.12c",
-            "aus": "26/27"
-        },
-        2000: {
-            "uiaa": "9",
-            "french": "7c",
-            "yds": "5.12c",
-            "aus": "27"
-        },
-        2020: {
-            "uiaa": "9",
-            "french": "7c",
-            "yds": "5.12c",
-            "aus": "27/28"
-        },
-        2050: {
-            "uiaa": "9/9+",
-            "french": "7c/+",
-            "yds": "5.12c/5.12d",
-            "aus": "28"
-        },
-        2100: {
-            "uiaa": "9+",
-            "french": "7c+",
-            "yds": "5.12d",
-            "aus": "28/29"
-        },
-        2150: {
-            "uiaa": "9+",
-            "french": "7c+/8a",
-            "yds": "5.12d/5.13a",
-            "aus": "29"
-        },
-        2200: {
-            "uiaa": "9+/10-",
-            "french": "8a",
-            "yds": "5.13a",
-            "aus": "29/30"
-        },
-        2250: {
-            "uiaa": "9+/10-",
-            "french": "8a",
-            "yds": "5.13a/5.13b",
-            "aus": "29/30"
-        },
-        2300: {
-            "uiaa": "10-",
-            "french": "8a/+",
-            "yds": "5.13b",
-            "aus": "30"
-        },
-        2325: {
-            "uiaa": "10-",
-            "french": "8a/+",
-            "yds": "5.13b/5.13c",
-            "aus": "30"
-        },
-        2350: {
-            "uiaa": "10-/10",
-            "french": "8a+",
-            "yds": "5.13c",
-            "aus": "30/31"
-        },
-        2375: {
-            "uiaa": "10-/10",
-            "french": "8a+/8b",
-            "yds": "5.13c/5.13d",
-            "aus": "30/31"
-        },
-        2400: {
-            "uiaa": "10",
-            "french": "8b",
-            "yds": "5.13d",
-            "aus": "31"
-        },
-        2450: {
-            "uiaa": "10/10+",
-            "french": "8b/+",
-            "yds": "5.13d/5.14a",
-            "aus": "31/32"
-        },
-        2500: {
-            "uiaa": "10+",
-            "french": "8b+",
-            "yds": "5.14a",
-            "aus": "32"
-        },
-        2520: {
-            "uiaa": "10+",
-            "french": "8b+",
-            "yds": "5.14a",
-            "aus": "32/33"
-        },
-        2550: {
-            "uiaa": "10+/11-",
-            "french": "8b+/8c",
-            "yds": "5.14a/5.14b",
-            "aus": "33"
-        },
-        2600: {
-            "uiaa": "11-",
-            "french": "8c",
-            "yds": "5.14b",
-            "aus": "33/34"
-        },
-        2650: {
-            "uiaa": "11-",
-            "french": "8c/+",
-            "yds": "5.14b/5.14c",
-            "aus": "34"
-        },
-        2700: {
-            "uiaa": "11-/11",
-            "french": "8c+",
-            "yds": "5.14c",
-            "aus": "34/35"
-        },
-        2750: {
-            "uiaa": "11-/11",
-            "french": "8c+/9a",
-            "yds": "5.14c/5.14d",
-            "aus": "34/35"
-        },
-        2800: {
-            "uiaa": "11",
-            "french": "9a",
-            "yds": "5.14d",
-            "aus": "35"
-        },
-        2850: {
-            "uiaa": "11",
-            "french": "9a/+",
-            "yds": "5.14d/5.15a",
-            "aus": "35"
-        },
-        2900: {
-            "uiaa": "11/11+",
-            "french": "9a+",
-            "yds": "5.15a",
-            "aus": "35/36"
-        },
-        3000: {
-            "uiaa": "11+",
-            "french": "9a+/9b",
-            "yds": "5.15a/5.15b",
-            "aus": "36"
-        },
-        3050: {
-            "uiaa": "11+/12-",
-            "french": "9a+/9b",
-            "yds": "5.15a/5.15b",
-            "aus": "36/37"
-        },
-        3100: {
-            "uiaa": "12-",
-            "french": "9b",
-            "yds": "5.15b",
-            "aus": "37"
-        },
-        3150: {
-            "uiaa": "12-/12",
-            "french": "9b/+",
-            "yds": "5.15b/5.15c",
-            "aus": "37/38"
-        },
-        3200: {
-            "uiaa": "12",
-            "french": "9b+",
-            "yds": "5.15c",
-            "aus": "38"
-        },
-        3250: {
-            "uiaa": "12/12+",
-            "french": "9b+/9c",
-            "yds": "5.15c/5.15d",
-            "aus": "38/39"
-        },
-        3300: {
-            "uiaa": "12+",
-            "french": "9c",
-            "yds": "5.15d",
-            "aus": "39"
-        },
-        9700: {
-            "v-scale": "VB-",
-            "fontainebleau": "1"
-        },
-        9750: {
-            "v-scale": "VB-",
-            "fontainebleau": "2"
-        },
-        9770: {
-            "v-scale": "VB-/VB",
-            "fontainebleau": "2"
-        },
-        9800: {
-            "v-scale": "VB",
-            "fontainebleau": "3"
-        },
-        9830: {
-            "v-scale": "VB",
-            "fontainebleau": "3/4a"
-        },
-        9850: {
-            "v-scale": "VB/V0-",
-            "fontainebleau": "4a"
-        },
-        9950: {
-            "v-scale": "V0-",
-            "fontainebleau": "4a/4b"
-        },
-        9975: {
-            "v-scale": "V0-/V0",
-            "fontainebleau": "4b"
-        },
-        10000: {
-            "v-scale": "V0",
-            "fontainebleau": "4b/4c"
-        },
-        10025: {
-            "v-scale": "V0/V0+",
-            "fontainebleau": "4c"
-        },
-        10050: {
-            "v-scale": "V0+",
-            "fontainebleau": "4c/5a"
-        },
-        10075: {
-            "v-scale": "V0+/V1",
-            "fontainebleau": "5a"
-        },
-        10150: {
-            "v-scale": "V0+/V1",
-            "fontainebleau": "5a/5b"
-        },
-        10200: {
-            "v-scale": "V1",
-            "fontainebleau": "5b"
-        },
-        10300: {
-            "v-scale": "V1/V2",
-            "fontainebleau": "5b/5c"
-        },
-        10400: {
-            "v-scale": "V2",
-            "fontainebleau": "5c"
-        },
-        10500: {
-            "v-scale": "V2/V3",
-            "fontainebleau": "5+/6a"
-        },
-        10600: {
-            "v-scale": "V3",
-            "fontainebleau": "6a"
-        },
-        10700: {
-            "v-scale": "V3",
-            "fontainebleau": "6a/6a+"
-        },
-        10800: {
-            "v-scale": "V3",
-            "fontainebleau": "6a+"
-        },
-        10900: {
-            "v-scale": "V3/V4",
-            "fontainebleau": "6a+/6b"
-        },
-        11000: {
-            "v-scale": "V3/V4",
-            "fontainebleau": "6b"
-        },
-        11100: {
-            "v-scale": "V4",
-            "fontainebleau": "6b/6b+"
-        },
-        11200: {
-            "v-scale": "V4",
-            "fontainebleau": "6b+"
-        },
-        11300: {
-            "v-scale": "V4/V5",
-            "fontainebleau": "6b+/6c"
-        },
-        11400: {
-            "v-scale": "V5",
-            "fontainebleau": "6c"
-        },
-        11500: {
-            "v-scale": "V5",
-            "fontainebleau": "6c/6c+"
-        },
-        11600: {
-            "v-scale": "V5/V6",
-            "fontainebleau": "6c+"
-        },
-        11650: {
-            "v-scale": "V5/V6",
-            "fontainebleau": "6c+/7a"
-        },
-        11700: {
-            "v-scale": "V6",
-            "fontainebleau": "7a"
-        },
-        11800: {
-            "v-scale": "V6/V7",
-            "fontainebleau": "7a/7a+"
-        },
-        11900: {
-            "v-scale": "V7",
-            "fontainebleau": "7a+"
-        },
-        12000: {
-            "v-scale": "V7/V8",
-            "fontainebleau": "7a+/7b"
-        },
-        12100: {
-            "v-scale": "V8",
-            "fontainebleau": "7b"
-        },
-        12200: {
-            "v-scale": "V8",
-            "fontainebleau": "7b/7b+"
-        },
-        12300: {
-            "v-scale": "V8",
-            "fontainebleau": "7b+"
-        },
-        12400: {
-            "v-scale": "V8/V9",
-            "fontainebleau": "7b+/7c"
-        },
-        12500: {
-            "v-scale": "V9",
-            "fontainebleau": "7c"
-        },
-        12600: {
-            "v-scale": "V9/V10",
-            "fontainebleau": "7c/7c+"
-        },
-        12700: {
-            "v-scale": "V10",
-            "fontainebleau": "7c+"
-        },
-        12800: {
-            "v-scale": "V10/V11",
-            "fontainebleau": "7c+/8a"
-        },
-        12900: {
-            "v-scale": "V11",
-            "fontainebleau": "8a"
-        },
-        13000: {
-            "v-scale": "V11/V12",
-            "fontainebleau": "8a/8a+"
-        },
-        13100: {
-            "v-scale": "V12",
-            "fontainebleau": "8a+"
-        },
-        13200: {
-            "v-scale": "V12/V13",
-            "fontainebleau": "8a+/8b"
-        },
-        13300: {
-            "v-scale": "V13",
-            "fontainebleau": "8b"
-        },
-        13400: {
-            "v-scale": "V13/V14",
-            "fontainebleau": "8b/8b+"
-        },
-        13500: {
-            "v-scale": "V14",
-            "fontainebleau": "8b+"
-        },
-        13600: {
-            "v-scale": "V14/V15",
-            "fontainebleau": "8b+/8c"
-        },
-        13700: {
-            "v-scale": "V15",
-            "fontainebleau": "8c"
-        },
-        13800: {
-            "v-scale": "V15/V16",
-            "fontainebleau": "8c/8c+"
-        },
-        13900: {
-            "v-scale": "V16",
-            "fontainebleau": "8c+"
-        },
-        14000: {
-            "v-scale": "V16/V17",
-            "fontainebleau": "8c+/9a"
-        },
-        14100: {
-            "v-scale": "V17",
-            "fontainebleau": "9a"
-        }
-    }[route['grade_id']]
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
 
-    if route['original_grade_system']:
-        return grade[route['original_grade_system'].lower()]
+    @staticmethod
+    def percentile(values, percent):
+        return values[max(0, math.ceil(len(values) * percent / 100) - 1)]
 
-    if 'wi-scale' in grade:
-        return grade['wi-scale']
-    if 'french' in grade:
-        return grade['french']
-    if 'fontainebleau' in grade:
-        return grade['fontainebleau']
+    def summary(self):
+        with self.lock:
+            stages = {}
+            for stage, timings in self.timings.items():
+                timings = sorted(timings)
+                stages[stage] = {
+                    'count': len(timings),
+                    'total': sum(timings),
+                    'p50': self.percentile(timings, 50),
+                    'p90': self.percentile(timings, 90),
+                    'p99': self.percentile(timings, 99),
+                    'max': timings[-1]
+                }
+            return {
+                'stages': stages,
+                'counters': dict(self.counters),
+                'sessions': {str(session_id): dict(timings) for session_id, timings in self.sessions.items()}
+            }
 
-    raise Exception()
+    def format_summary(self):
+        summary = self.summary()
+        lines = [f"{'stage':<16}{'count':>8}{'total':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}"] if summary['stages'] else []
+        for stage, timings in summary['stages'].items():
+            lines.append(
+                f"{stage:<16}{timings['count']:>8}{timings['total']:>10.3f}"
+                f"{timings['p50']:>10.3f}{timings['p90']:>10.3f}{timings['p99']:>10.3f}{timings['max']:>10.3f}"
+            )
+        lines.extend(f"{name:<24}{value:>8}" for name, value in sorted(summary['counters'].items()))
+        return '\n'.join(lines)
+
+    def format_prometheus(self, labels=None):
+        summary = self.summary()
+        labels = ''.join(f',{name}="{value}"' for name, value in (labels or {}).items())
+        lines = [
+            '# HELP ctb2strava_stage_seconds Time spent per stage during the last run',
+            '# TYPE ctb2strava_stage_seconds summary'
+        ]
+        for stage, timings in summary['stages'].items():
+            for quantile in ('p50', 'p90', 'p99'):
+                lines.append(f'ctb2strava_stage_seconds{{stage="{stage}",quantile="0.{quantile[1:]}"{labels}}} {timings[quantile]}')
+            lines.append(f'ctb2strava_stage_seconds_sum{{stage="{stage}"{labels}}} {timings["total"]}')
+            lines.append(f'ctb2strava_stage_seconds_count{{stage="{stage}"{labels}}} {timings["count"]}')
+        lines.extend([
+            '# HELP ctb2strava_events Events counted during the last run',
+            '# TYPE ctb2strava_events gauge'
+        ])
+        lines.extend(f'ctb2strava_events{{event="{name}"{labels}}} {value}' for name, value in sorted(summary['counters'].items()))
+        lines.extend([
+            '# HELP ctb2strava_last_run_timestamp_seconds End of the last run',
+            '# TYPE ctb2strava_last_run_timestamp_seconds gauge',
+            f'ctb2strava_last_run_timestamp_seconds{{{labels[1:]}}} {time.time()}' if labels else f'ctb2strava_last_run_timestamp_seconds {time.time()}'
+        ])
+        return '\n'.join(lines) + '\n'
+
+stats = Stats()
+
+def timed(iterable, durations):
+    # Collects the time spent producing each item
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            durations.append(time.perf_counter() - start)
+            return
+        durations.append(time.perf_counter() - start)
+        yield item
+
+class _JsonReader:
+    _whitespace = re.compile(r'[ \t\n\r]*')
+    _number_tail = re.compile(r'[0-9.eE+-]*')
+
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.position = self._whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON document")
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(f"Expected one of {chars!r} but found {char!r}")
+        self.position += 1
+        return char
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number followed by nothing but number characters may continue in the next chunk
+            number = isinstance(value, (int, float)) and not isinstance(value, bool)
+            if number and self._number_tail.match(self.buffer, end).end() == len(self.buffer) and self._fill():
+                continue
+            self.position = end
+            return value
+
+def iter_json_arrays(path, chunk_size=1 << 16):
+    # Yields (key, item) for the items of the top-level arrays, one item in memory at a time
+    with open(path, encoding='utf-8') as file:
+        reader = _JsonReader(file, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            key = reader.decode()
+            reader.expect(':')
+            if reader.peek() == '[':
+                reader.expect('[')
+                if reader.peek() == ']':
+                    reader.expect(']')
+                else:
+                    while True:
+                        yield key, reader.decode()
+                        if reader.expect(',]') == ']':
+                            break
+            else:
+                reader.decode()
+            if reader.expect(',}') == '}':
+                return
+
+def stream_backup(path, last_export):
+    last_export = datetime.fromisoformat(last_export)
+
+    sessions = []
+    for key, item in iter_json_arrays(path):
+        if key == 'sessions':
+            if datetime.fromisoformat(item['time_start']) > last_export:
+                sessions.append(item)
+        elif sessions:
+            break
+
+    session_ids = {session['session_id'] for session in sessions}
+    location_ids = {session['location_id'] for session in sessions}
+    routes = []
+    locations = []
+    if sessions:
+        for key, item in iter_json_arrays(path):
+            if key == 'routes' and item['session_id'] in session_ids:
+                routes.append(item)
+            elif key == 'locations' and item['location_id'] in location_ids:
+                locations.append(item)
+
+    return {
+        'sessions': sessions,
+        'routes': routes,
+        'locations': locations
+    }
+
+def index_backup(ctb):
+    locations = {location['location_id']: location for location in ctb['locations']}
+
+    routes = {}
+    for route in ctb['routes']:
+        routes.setdefault(route['session_id'], []).append(route)
+    for session_routes in routes.values():
+        session_routes.sort(key=lambda x: x['ascend_order'])
+
+    sessions = sorted(ctb['sessions'], key=lambda x: datetime.fromisoformat(x['time_start']))
+
+    return {
+        'locations': locations,
+        'routes': routes,
+        'sessions': sessions,
+        'session_times': [datetime.fromisoformat(session['time_start']) for session in sessions]
+    }
+
+def get_new_sessions(backup, last_export):
+    return backup['sessions'][bisect_right(backup['session_times'], datetime.fromisoformat(last_export)):]
+
+def get_location(backup, session):
+    return backup['locations'].get(session['location_id'])
+
+def get_routes(backup, session):
+    return backup['routes'].get(session['session_id'], [])
+
+GRADES = {
+    5: {
+        "wi-scale": "WI-1"
+    },
+    10: {
+        "wi-scale": "WI-2"
+    },
+    15: {
+        "wi-scale": "WI-3"
+    },
+    20: {
+        "wi-scale": "WI-4"
+    },
+    25: {
+        "wi-scale": "WI-5"
+    },
+    30: {
+        "wi-scale": "WI-6"
+    },
+    35: {
+        "wi-scale": "WI-7"
+    },
+    40: {
+        "wi-scale": "WI-8"
+    },
+    100: {
+        "uiaa": "1",
+        "french": "1",
+        "yds": "5.0",
+        "aus": "10"
+    },
+    150: {
+        "uiaa": "1",
+        "french": "1/2",
+        "yds": "5.0/5.1",
+        "aus": "10/11"
+    },
+    200: {
+        "uiaa": "2",
+        "french": "2",
+        "yds": "5.1",
+        "aus": "11"
+    },
+    250: {
+        "uiaa": "2+",
+        "french": "2/3",
+        "yds": "5.1/5.2",
+        "aus": "11/12"
+    },
+    275: {
+        "uiaa": "3-",
+        "french": "2/3",
+        "yds": "5.1/5.2",
+        "aus": "11/12"
+    },
+    300: {
+        "uiaa": "3",
+        "french": "3",
+        "yds": "5.2",
+        "aus": "12"
+    },
+    320: {
+        "uiaa": "3/3+",
+        "french": "3",
+        "yds": "5.2",
+        "aus": "12"
+    },
+    350: {
+        "uiaa": "3+",
+        "french": "3/4a",
+        "yds": "5.2/5.3",
+        "aus": "12/13"
+    },
+    365: {
+        "uiaa": "3+/4-",
+        "french": "3/4a",
+        "yds": "5.2/5.3",
+        "aus": "12/13"
+    },
+    375: {
+        "uiaa": "4-",
+        "french": "4a",
+        "yds": "5.3",
+        "aus": "13"
+    },
+    385: {
+        "uiaa": "4-/4",
+        "french": "4a/4b",
+        "yds": "5.3",
+        "aus": "13"
+    },
+    400: {
+        "uiaa": "4",
+        "french": "4b",
+        "yds": "5.3",
+        "aus": "13"
+    },
+    425: {
+        "uiaa": "4/4+",
+        "french": "4b/4c",
+        "yds": "5.3/5.4",
+        "aus": "13/14"
+    },
+    450: {
+        "uiaa": "4+",
+        "french": "4c",
+        "yds": "5.4",
+        "aus": "14"
+    },
+    475: {
+        "uiaa": "4+/5-",
+        "french": "4c/5a",
+        "yds": "5.4/5.5",
+        "aus": "14/15"
+    },
+    500: {
+        "uiaa": "5-",
+        "french": "5a",
+        "yds": "5.5",
+        "aus": "14/15"
+    },
+    550: {
+        "uiaa": "5-/5",
+        "french": "5a/+",
+        "yds": "5.5/5.6",
+        "aus": "14/15"
+    },
+    600: {
+        "uiaa": "5",
+        "french": "5a+",
+        "yds": "5.6",
+        "aus": "15"
+    },
+    650: {
+        "uiaa": "5/5+",
+        "french": "5a+/5b",
+        "yds": "5.6/5.7",
+        "aus": "15/16"
+    },
+    700: {
+        "uiaa": "5+",
+        "french": "5b",
+        "yds": "5.7",
+        "aus": "16"
+    },
+    750: {
+        "uiaa": "5+/6-",
+        "french": "5b/+",
+        "yds": "5.7/5.8",
+        "aus": "16/17"
+    },
+    800: {
+        "uiaa": "6-",
+        "french": "5b+",
+        "yds": "5.8",
+        "aus": "17"
+    },
+    850: {
+        "uiaa": "6-/6",
+        "french": "5b+/5c",
+        "yds": "5.8/5.9",
+        "aus": "17/18"
+    },
+    900: {
+        "uiaa": "6",
+        "french": "5c",
+        "yds": "5.9",
+        "aus": "18"
+    },
+    920: {
+        "uiaa": "6",
+        "french": "5c/+",
+        "yds": "5.9",
+        "aus": "18"
+    },
+    940: {
+        "uiaa": "6/6+",
+        "french": "5c+",
+        "yds": "5.9/5.10a,",
+        "aus": "18/19"
+    },
+    950: {
+        "uiaa": "6/6+",
+        "french": "5c+/6a",
+        "yds": "5.9/5.10a",
+        "aus": "18/19"
+    },
+    1000: {
+        "uiaa": "6+",
+        "french": "6a",
+        "yds": "5.10a",
+        "aus": "19"
+    },
+    1050: {
+        "uiaa": "6+/7-",
+        "french": "6a/+",
+        "yds": "5.10a/5.10b",
+        "aus": "19/20"
+    },
+    1100: {
+        "uiaa": "7-",
+        "french": "6a+",
+        "yds": "5.10b",
+        "aus": "20"
+    },
+    1150: {
+        "uiaa": "7-/7",
+        "french": "6a+/6b",
+        "yds": "5.10b/5.10c",
+        "aus": "20/21"
+    },
+    1200: {
+        "uiaa": "7",
+        "french": "6b",
+        "yds": "5.10c",
+        "aus": "21"
+    },
+    1250: {
+        "uiaa": "7/7+",
+        "french": "6b/+",
+        "yds": "5.10c/5.10d",
+        "aus": "21/22"
+    },
+    1300: {
+        "uiaa": "7+",
+        "french": "6b+",
+        "yds": "5.10d",
+        "aus": "22"
+    },
+    1350: {
+        "uiaa": "7+",
+        "french": "6b+/6c",
+        "yds": "5.10d/5.11a",
+        "aus": "22"
+    },
+    1400: {
+        "uiaa": "7+/8-",
+        "french": "6c",
+        "yds": "5.11a",
+        "aus": "22/23"
+    },
+    1450: {
+        "uiaa": "7+/8-",
+        "french": "6c/+",
+        "yds": "5.11a/5.11b",
+        "aus": "22/23"
+    },
+    1500: {
+        "uiaa": "8-",
+        "french": "6c+",
+        "yds": "5.11b",
+        "aus": "23"
+    },
+    1550: {
+        "uiaa": "8-/8",
+        "french": "6c+/7a",
+        "yds": "5.11b/5.11c",
+        "aus": "23/24"
+    },
+    1600: {
+        "uiaa": "8",
+        "french": "7a",
+        "yds": "5.11c",
+        "aus": "24"
+    },
+    1650: {
+        "uiaa": "8/8+",
+        "french": "7a/+",
+        "yds": "5.11c/5.11d",
+        "aus": "24/25"
+    },
+    1700: {
+        "uiaa": "8+",
+        "french": "7a+",
+        "yds": "5.11d",
+        "aus": "25"
+    },
+    1750: {
+        "uiaa": "8+",
+        "french": "7a+/7b",
+        "yds": "5.11d/5.12a",
+        "aus": "25"
+    },
+    1800: {
+        "uiaa": "8+/9-",
+        "french": "7b",
+        "yds": "5.12a",
+        "aus": "25/26"
+    },
+    1850: {
+        "uiaa": "8+/9-",
+        "french": "7b/+",
+        "yds": "5.12a/5.12b",
+        "aus": "25/26"
+    },
+    1900: {
+        "uiaa": "9-",
+        "french": "7b+",
+        "yds": "5.12b",
+        "aus": "26"
+    },
+    1950: {
+        "uiaa": "9-/9",
+        "french": "7b+/7c",
+        "yds": "5.12b/5.12c",
+        "aus": "26/27"
+    },
+    2000: {
+        "uiaa": "9",
+        "french": "7c",
+        "yds": "5.12c",
+        "aus": "27"
+    },
+    2020: {
+        "uiaa": "9",
+        "french": "7c",
+        "yds": "5.12c",
+        "aus": "27/28"
+    },
+    2050: {
+        "uiaa": "9/9+",
+        "french": "7c/+",
+        "yds": "5.12c/5.12d",
+        "aus": "28"
+    },
+    2100: {
+        "uiaa": "9+",
+        "french": "7c+",
+        "yds": "5.12d",
+        "aus": "28/29"
+    },
+    2150: {
+        "uiaa": "9+",
+        "french": "7c+/8a",
+        "yds": "5.12d/5.13a",
+        "aus": "29"
+    },
+    2200: {
+        "uiaa": "9+/10-",
+        "french": "8a",
+        "yds": "5.13a",
+        "aus": "29/30"
+    },
+    2250: {
+        "uiaa": "9+/10-",
+        "french": "8a",
+        "yds": "5.13a/5.13b",
+        "aus": "29/30"
+    },
+    2300: {
+        "uiaa": "10-",
+        "french": "8a/+",
+        "yds": "5.13b",
+        "aus": "30"
+    },
+    2325: {
+        "uiaa": "10-",
+        "french": "8a/+",
+        "yds": "5.13b/5.13c",
+        "aus": "30"
+    },
+    2350: {
+        "uiaa": "10-/10",
+        "french": "8a+",
+        "yds": "5.13c",
+        "aus": "30/31"
+    },
+    2375: {
+        "uiaa": "10-/10",
+        "french": "8a+/8b",
+        "yds": "5.13c/5.13d",
+        "aus": "30/31"
+    },
+    2400: {
+        "uiaa": "10",
+        "french": "8b",
+        "yds": "5.13d",
+        "aus": "31"
+    },
+    2450: {
+        "uiaa": "10/10+",
+        "french": "8b/+",
+        "yds": "5.13d/5.14a",
+        "aus": "31/32"
+    },
+    2500: {
+        "uiaa": "10+",
+        "french": "8b+",
+        "yds": "5.14a",
+        "aus": "32"
+    },
+    2520: {
+        "uiaa": "10+",
+        "french": "8b+",
+        "yds": "5.14a",
+        "aus": "32/33"
+    },
+    2550: {
+        "uiaa": "10+/11-",
+        "french": "8b+/8c",
+        "yds": "5.14a/5.14b",
+        "aus": "33"
+    },
+    2600: {
+        "uiaa": "11-",
+        "french": "8c",
+        "yds": "5.14b",
+        "aus": "33/34"
+    },
+    2650: {
+        "uiaa": "11-",
+        "french": "8c/+",
+        "yds": "5.14b/5.14c",
+        "aus": "34"
+    },
+    2700: {
+        "uiaa": "11-/11",
+        "french": "8c+",
+        "yds": "5.14c",
+        "aus": "34/35"
+    },
+    2750: {
+        "uiaa": "11-/11",
+        "french": "8c+/9a",
+        "yds": "5.14c/5.14d",
+        "aus": "34/35"
+    },
+    2800: {
+        "uiaa": "11",
+        "french": "9a",
+        "yds": "5.14d",
+        "aus": "35"
+    },
+    2850: {
+        "uiaa": "11",
+        "french": "9a/+",
+        "yds": "5.14d/5.15a",
+        "aus": "35"
+    },
+    2900: {
+        "uiaa": "11/11+",
+        "french": "9a+",
+        "yds": "5.15a",
+        "aus": "35/36"
+    },
+    3000: {
+        "uiaa": "11+",
+        "french": "9a+/9b",
+        "yds": "5.15a/5.15b",
+        "aus": "36"
+    },
+    3050: {
+        "uiaa": "11+/12-",
+        "french": "9a+/9b",
+        "yds": "5.15a/5.15b",
+        "aus": "36/37"
+    },
+    3100: {
+        "uiaa": "12-",
+        "french": "9b",
+        "yds": "5.15b",
+        "aus": "37"
+    },
+    3150: {
+        "uiaa": "12-/12",
+        "french": "9b/+",
+        "yds": "5.15b/5.15c",
+        "aus": "37/38"
+    },
+    3200: {
+        "uiaa": "12",
+        "french": "9b+",
+        "yds": "5.15c",
+        "aus": "38"
+    },
+    3250: {
+        "uiaa": "12/12+",
+        "french": "9b+/9c",
+        "yds": "5.15c/5.15d",
+        "aus": "38/39"
+    },
+    3300: {
+        "uiaa": "12+",
+        "french": "9c",
+        "yds": "5.15d",
+        "aus": "39"
+    },
+    9700: {
+        "v-scale": "VB-",
+        "fontainebleau": "1"
+    },
+    9750: {
+        "v-scale": "VB-",
+        "fontainebleau": "2"
+    },
+    9770: {
+        "v-scale": "VB-/VB",
+        "fontainebleau": "2"
+    },
+    9800: {
+        "v-scale": "VB",
+        "fontainebleau": "3"
+    },
+    9830: {
+        "v-scale": "VB",
+        "fontainebleau": "3/4a"
+    },
+    9850: {
+        "v-scale": "VB/V0-",
+        "fontainebleau": "4a"
+    },
+    9950: {
+        "v-scale": "V0-",
+        "fontainebleau": "4a/4b"
+    },
+    9975: {
+        "v-scale": "V0-/V0",
+        "fontainebleau": "4b"
+    },
+    10000: {
+        "v-scale": "V0",
+        "fontainebleau": "4b/4c"
+    },
+    10025: {
+        "v-scale": "V0/V0+",
+        "fontainebleau": "4c"
+    },
+    10050: {
+        "v-scale": "V0+",
+        "fontainebleau": "4c/5a"
+    },
+    10075: {
+        "v-scale": "V0+/V1",
+        "fontainebleau": "5a"
+    },
+    10150: {
+        "v-scale": "V0+/V1",
+        "fontainebleau": "5a/5b"
+    },
+    10200: {
+        "v-scale": "V1",
+        "fontainebleau": "5b"
+    },
+    10300: {
+        "v-scale": "V1/V2",
+        "fontainebleau": "5b/5c"
+    },
+    10400: {
+        "v-scale": "V2",
+        "fontainebleau": "5c"
+    },
+    10500: {
+        "v-scale": "V2/V3",
+        "fontainebleau": "5+/6a"
+    },
+    10600: {
+        "v-scale": "V3",
+        "fontainebleau": "6a"
+    },
+    10700: {
+        "v-scale": "V3",
+        "fontainebleau": "6a/6a+"
+    },
+    10800: {
+        "v-scale": "V3",
+        "fontainebleau": "6a+"
+    },
+    10900: {
+        "v-scale": "V3/V4",
+        "fontainebleau": "6a+/6b"
+    },
+    11000: {
+        "v-scale": "V3/V4",
+        "fontainebleau": "6b"
+    },
+    11100: {
+        "v-scale": "V4",
+        "fontainebleau": "6b/6b+"
+    },
+    11200: {
+        "v-scale": "V4",
+        "fontainebleau": "6b+"
+    },
+    11300: {
+        "v-scale": "V4/V5",
+        "fontainebleau": "6b+/6c"
+    },
+    11400: {
+        "v-scale": "V5",
+        "fontainebleau": "6c"
+    },
+    11500: {
+        "v-scale": "V5",
+        "fontainebleau": "6c/6c+"
+    },
+    11600: {
+        "v-scale": "V5/V6",
+        "fontainebleau": "6c+"
+    },
+    11650: {
+        "v-scale": "V5/V6",
+        "fontainebleau": "6c+/7a"
+    },
+    11700: {
+        "v-scale": "V6",
+        "fontainebleau": "7a"
+    },
+    11800: {
+        "v-scale": "V6/V7",
+        "fontainebleau": "7a/7a+"
+    },
+    11900: {
+        "v-scale": "V7",
+        "fontainebleau": "7a+"
+    },
+    12000: {
+        "v-scale": "V7/V8",
+        "fontainebleau": "7a+/7b"
+    },
+    12100: {
+        "v-scale": "V8",
+        "fontainebleau": "7b"
+    },
+    12200: {
+        "v-scale": "V8",
+        "fontainebleau": "7b/7b+"
+    },
+    12300: {
+        "v-scale": "V8",
+        "fontainebleau": "7b+"
+    },
+    12400: {
+        "v-scale": "V8/V9",
+        "fontainebleau": "7b+/7c"
+    },
+    12500: {
+        "v-scale": "V9",
+        "fontainebleau": "7c"
+    },
+    12600: {
+        "v-scale": "V9/V10",
+        "fontainebleau": "7c/7c+"
+    },
+    12700: {
+        "v-scale": "V10",
+        "fontainebleau": "7c+"
+    },
+    12800: {
+        "v-scale": "V10/V11",
+        "fontainebleau": "7c+/8a"
+    },
+    12900: {
+        "v-scale": "V11",
+        "fontainebleau": "8a"
+    },
+    13000: {
+        "v-scale": "V11/V12",
+        "fontainebleau": "8a/8a+"
+    },
+    13100: {
+        "v-scale": "V12",
+        "fontainebleau": "8a+"
+    },
+    13200: {
+        "v-scale": "V12/V13",
+        "fontainebleau": "8a+/8b"
+    },
+    13300: {
+        "v-scale": "V13",
+        "fontainebleau": "8b"
+    },
+    13400: {
+        "v-scale": "V13/V14",
+        "fontainebleau": "8b/8b+"
+    },
+    13500: {
+        "v-scale": "V14",
+        "fontainebleau": "8b+"
+    },
+    13600: {
+        "v-scale": "V14/V15",
+        "fontainebleau": "8b+/8c"
+    },
+    13700: {
+        "v-scale": "V15",
+        "fontainebleau": "8c"
+    },
+    13800: {
+        "v-scale": "V15/V16",
+        "fontainebleau": "8c/8c+"
+    },
+    13900: {
+        "v-scale": "V16",
+        "fontainebleau": "8c+"
+    },
+    14000: {
+        "v-scale": "V16/V17",
+        "fontainebleau": "8c+/9a"
+    },
+    14100: {
+        "v-scale": "V17",
+        "fontainebleau": "9a"
+    }
+}
+
+GRADE_SYSTEMS = ('french', 'uiaa', 'yds', 'aus', 'fontainebleau', 'v-scale', 'wi-scale')
+# Grades only convert within a family, each family uses its own range of ids
+GRADE_FAMILIES = {
+    'rope': ('french', 'uiaa', 'yds', 'aus'),
+    'boulder': ('fontainebleau', 'v-scale'),
+    'ice': ('wi-scale',)
+}
+GRADE_SYSTEM_FAMILIES = {system: family for family, systems in GRADE_FAMILIES.items() for system in systems}
+# Other route types are graded on the rope scales
+ROUTE_TYPE_GRADE_FAMILIES = {
+    'BOULDER': 'boulder',
+    'ICE_CLIMBING': 'ice'
+}
+
+def _compile_grades():
+    ids = sorted(GRADES)
+    tables = {system: [None] * (ids[-1] + 1) for system in GRADE_SYSTEMS}
+    system_ids = {system: [] for system in GRADE_SYSTEMS}
+    name_ids = {system: {} for system in GRADE_SYSTEMS}
+    for grade_id in ids:
+        for system, name in GRADES[grade_id].items():
+            tables[system][grade_id] = name
+            system_ids[system].append(grade_id)
+            name_ids[system].setdefault(name, grade_id)
+    return ids, tables, system_ids, name_ids
+
+GRADE_IDS, GRADE_TABLES, GRADE_SYSTEM_IDS, GRADE_NAME_IDS = _compile_grades()
+
+def get_nearest_grade_id(grade_id, ids=GRADE_IDS):
+    index = bisect_left(ids, grade_id)
+    return min(ids[max(index - 1, 0):index + 1], key=lambda x: abs(x - grade_id))
+
+def get_grade_name(grade_id, system):
+    # Missing ids resolve to the nearest grade of the system, clamped to its first and last grades
+    table = GRADE_TABLES[system]
+    if 0 <= grade_id < len(table) and table[grade_id] is not None:
+        return table[grade_id]
+    return table[get_nearest_grade_id(grade_id, GRADE_SYSTEM_IDS[system])]
+
+def convert_grade(name, from_system, to_system):
+    from_system, to_system = from_system.lower(), to_system.lower()
+    for system in (from_system, to_system):
+        if system not in GRADE_SYSTEM_FAMILIES:
+            raise ValueError(f"Unknown grade system {system}")
+    if GRADE_SYSTEM_FAMILIES[from_system] != GRADE_SYSTEM_FAMILIES[to_system]:
+        raise ValueError(f"{from_system} grades have no {to_system} equivalent")
+    grade_id = GRADE_NAME_IDS[from_system].get(name)
+    if grade_id is None:
+        raise ValueError(f"Unknown {from_system} grade {name}")
+    return get_grade_name(grade_id, to_system)
+
+def get_route_grade_name(route):
+    if route['route_type'] == 'SPEED_CLIMBING' and route['speed_type'] == 0:
+        return "Std."
+
+    family = ROUTE_TYPE_GRADE_FAMILIES.get(route['route_type'], 'rope')
+    system = (route['original_grade_system'] or '').lower()
+    if system not in GRADE_FAMILIES[family]:
+        system = GRADE_FAMILIES[family][0]
+    return get_grade_name(route['grade_id'], system)
 
 def get_route_style_name(route):
     if route['route_type'] == 'SPEED_CLIMBING':
@@ -810,181 +1103,1230 @@ def get_route_height(route):
     }.get(route['style_id'], 1)
     return round(route['ascend_height']*coefficient)
 
-def get_best_route(routes, route_type, style_ids):
-    if route_type == 'SPEED_CLIMBING':
-        return min(filter(lambda y: y['route_type'] == route_type, routes), key=lambda x: x['speed_time'], default=None)
-
-    return max(filter(lambda y: y['route_type'] == route_type and y['style_id'] in style_ids, routes), key=lambda x: x['grade_id'], default=None)
-
 def get_title(location):
     return f"🧗 {'Outdoor' if location['location_outdoor'] == 1 else 'Indoor'} climbing / {location['location_name']}"
 
-def get_best_route_line(routes, route_type, clean_style_ids = None, dirty_style_ids = None):
-    best_route_clean = get_best_route(routes, route_type, clean_style_ids)
-    best_route_dirty = None
-    if dirty_style_ids:
-        best_route_dirty = get_best_route(routes, route_type, dirty_style_ids)
+BEST_ROUTE_STYLE_IDS = {
+    'SPORT_CLIMBING': ({1, 2, 3, 10}, {4, 5, 9}),
+    'BOULDER': ({100, 101, 103}, None),
+    'SPEED_CLIMBING': (None, None),
+    'MULTI_PITCH': ({1, 2, 3, 10}, {4, 5, 9}),
+    'TRAD_CLIMBING': ({1, 2, 3, 10}, {4, 5, 9}),
+    'ICE_CLIMBING': ({1, 2, 3, 10}, {4, 5, 9}),
+    'DEEP_WATER_SOLO': ({1, 2, 3, 10}, {4, 5, 9}),
+    'FREE_SOLO': ({1, 2, 3, 10}, {4, 5, 9})
+}
+
+def get_session_stats(routes):
+    # Heights and best clean and dirty routes of each type (fastest for speed climbing), in a single pass over the routes
+    heights = []
+    best_routes = {route_type: [None, None] for route_type in BEST_ROUTE_STYLE_IDS}
+    for route in routes:
+        heights.append(get_route_height(route))
+
+        route_type = route['route_type']
+        best = best_routes.get(route_type)
+        if best is None:
+            continue
+
+        if route_type == 'SPEED_CLIMBING':
+            if best[0] is None or route['speed_time'] < best[0]['speed_time']:
+                best[0] = route
+            continue
+
+        clean_style_ids, dirty_style_ids = BEST_ROUTE_STYLE_IDS[route_type]
+        if route['style_id'] in clean_style_ids:
+            index = 0
+        elif dirty_style_ids and route['style_id'] in dirty_style_ids:
+            index = 1
+        else:
+            continue
+        if best[index] is None or route['grade_id'] > best[index]['grade_id']:
+            best[index] = route
+
+    return {
+        'count': len(routes),
+        'heights': heights,
+        'climbed_height': sum(heights),
+        'best_routes': best_routes
+    }
+
+BEST_ROUTE_TYPE_NAMES = {
+    'SPORT_CLIMBING': "Sport climbing [S]",
+    'BOULDER': "Bouldering [B]",
+    'SPEED_CLIMBING': "Speed climbing [SPEED]",
+    'MULTI_PITCH': "Multi-pitch climbing [MP]",
+    'TRAD_CLIMBING': "Trad climbing [T]",
+    'ICE_CLIMBING': "Ice climbing [ICE]",
+    'DEEP_WATER_SOLO': "Deep water soloing [DWS]",
+    'FREE_SOLO': "Free soloing [FREE]"
+}
+
+# Fragments are str.format templates, they also receive the session and the route
+DESCRIPTION_TEMPLATE = {
+    'total_ascents': "Total ascents: {count:02d}\n",
+    'climbed_height': "Climbed height: {climbed_height} m\n",
+    'best_ascent': "Best ascent: \n",
+    'best_route': " - {route_type}:",
+    'best_route_clean': " {grade}",
+    'best_route_dirty': " ({grade})",
+    'best_route_end': "\n",
+    'best_ascent_end': "\n",
+    'comment': "{comment}\n\n",
+    'route': "{number:02d}",
+    'route_name': " | {name}",
+    'route_height': " | {height} m",
+    'route_header_end': "\n",
+    'route_details': "{grade} | {style} | {type}\n",
+    'route_comment': "{comment}\n",
+    'route_end': "\n"
+}
+
+class DescriptionRenderer:
+    def __init__(self, template=None):
+        self.formats = {name: fragment.format for name, fragment in {**DESCRIPTION_TEMPLATE, **(template or {})}.items()}
+
+    def render_best_route_line(self, parts, route_type, best_route_clean, best_route_dirty):
         if best_route_clean and best_route_dirty and best_route_dirty['grade_id'] <= best_route_clean['grade_id']:
             best_route_dirty = None
 
-    line = ""
-    if best_route_clean or best_route_dirty:
-        line += " - "
-        line += {
-            'SPORT_CLIMBING': "Sport climbing [S]",
-            'BOULDER': "Bouldering [B]",
-            'SPEED_CLIMBING': "Speed climbing [SPEED]",
-            'MULTI_PITCH': "Multi-pitch climbing [MP]",
-            'TRAD_CLIMBING': "Trad climbing [T]",
-            'ICE_CLIMBING': "Ice climbing [ICE]",
-            'DEEP_WATER_SOLO': "Deep water soloing [DWS]",
-            'FREE_SOLO': "Free soloing [FREE]"
-        }[route_type]
-        line += ":"
-
-        if best_route_clean:
-            line += f" {get_route_grade_name(best_route_clean)}"
-        if best_route_dirty:
-            line += f" ({get_route_grade_name(best_route_dirty)})"
-
-        line += "\n"
-
-    return line
-
-def get_description(session, routes):
-    # Only comment if no route
-    if not routes:
-        return session['session_comment']
-    
-    # Main
-    description = f"Total ascents: {len(routes):02d}\n"
-
-    climbed_height = sum(map(get_route_height, routes))
-    if climbed_height > 0:
-        description += f"Climbed height: {f'{climbed_height} m'}\n"
-
-    # Best ascent
-    description += f"Best ascent: \n"
-    description += get_best_route_line(routes, 'SPORT_CLIMBING', [1, 2, 3, 10], [4, 5, 9])
-    description += get_best_route_line(routes, 'BOULDER', [100, 101, 103])
-    description += get_best_route_line(routes, 'SPEED_CLIMBING')
-    description += get_best_route_line(routes, 'MULTI_PITCH', [1, 2, 3, 10], [4, 5, 9])
-    description += get_best_route_line(routes, 'TRAD_CLIMBING', [1, 2, 3, 10], [4, 5, 9])
-    description += get_best_route_line(routes, 'ICE_CLIMBING', [1, 2, 3, 10], [4, 5, 9])
-    description += get_best_route_line(routes, 'DEEP_WATER_SOLO', [1, 2, 3, 10], [4, 5, 9])
-    description += get_best_route_line(routes, 'FREE_SOLO', [1, 2, 3, 10], [4, 5, 9])
-    description += "\n"
-
-    # Comment
-    if session['session_comment']:
-        description += f"{session['session_comment']}\n\n"
-
-    # Routes
-    route_number = 1
-    for route in routes:
-        description += f"{route_number:02d}"
-        if route['route_name']:
-            description += f" | {route['route_name']}"
-        route_height = get_route_height(route)
-        if route_height > 0:
-            description += f" | {route_height} m"
-        description += "\n"
-
-        description += get_route_grade_name(route)
-        description += f" | {get_route_style_name(route)}"
-        description += f" | {get_route_type_name(route)}\n"
-
-        if route['comment']:
-            description += f"{route['comment']}\n"
-        
-        description += "\n"
-        route_number += 1
-
-    return description.strip()
-
-def arc(track_points, center_lat, center_lon, start_angle, stop_angle, current_time, time_end, get_elevation):
-    for angle in range(start_angle, stop_angle):
-        destination = geodesic(meters=25).destination((center_lat, center_lon), angle)
-        track_points.append(
-            gpx2strava.TrackPoint(
-                destination.latitude,
-                destination.longitude,
-                get_elevation(angle),
-                current_time
-            )
+        if best_route_clean or best_route_dirty:
+            parts.append(self.formats['best_route'](route_type=BEST_ROUTE_TYPE_NAMES[route_type]))
+            if best_route_clean:
+                parts.append(self.formats['best_route_clean'](grade=get_route_grade_name(best_route_clean), route=best_route_clean))
+            if best_route_dirty:
+                parts.append(self.formats['best_route_dirty'](grade=get_route_grade_name(best_route_dirty), route=best_route_dirty))
+            parts.append(self.formats['best_route_end']())
+
+    def render(self, session, routes):
+        # Only comment if no route
+        if not routes:
+            return session['session_comment']
+
+        formats = self.formats
+        stats = get_session_stats(routes)
+
+        # Main
+        parts = [formats['total_ascents'](count=stats['count'], session=session)]
+        if stats['climbed_height'] > 0:
+            parts.append(formats['climbed_height'](climbed_height=stats['climbed_height'], session=session))
+
+        # Best ascent
+        parts.append(formats['best_ascent']())
+        for route_type, (best_route_clean, best_route_dirty) in stats['best_routes'].items():
+            self.render_best_route_line(parts, route_type, best_route_clean, best_route_dirty)
+        parts.append(formats['best_ascent_end']())
+
+        # Comment
+        if session['session_comment']:
+            parts.append(formats['comment'](comment=session['session_comment'], session=session))
+
+        # Routes
+        for route_number, (route, route_height) in enumerate(zip(routes, stats['heights']), 1):
+            parts.append(formats['route'](number=route_number, route=route))
+            if route['route_name']:
+                parts.append(formats['route_name'](name=route['route_name'], route=route))
+            if route_height > 0:
+                parts.append(formats['route_height'](height=route_height, route=route))
+            parts.append(formats['route_header_end']())
+            parts.append(formats['route_details'](
+                grade=get_route_grade_name(route),
+                style=get_route_style_name(route),
+                type=get_route_type_name(route),
+                route=route
+            ))
+            if route['comment']:
+                parts.append(formats['route_comment'](comment=route['comment'], route=route))
+            parts.append(formats['route_end']())
+
+        return ''.join(parts).strip()
+
+default_renderer = DescriptionRenderer()
+
+def get_description(session, routes, renderer=None):
+    return (renderer or default_renderer).render(session, routes)
+
+@lru_cache(maxsize=256)
+def get_ring(center_lat, center_lon):
+    from geopy.distance import geodesic
+    distance = geodesic(meters=25)
+    return tuple(
+        (destination.latitude, destination.longitude)
+        for destination in (distance.destination((center_lat, center_lon), angle) for angle in range(360))
+    )
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def to_epoch_us(time):
+    return (time - EPOCH) // timedelta(microseconds=1)
+
+class Track:
+    # Columnar block of track points, times are microseconds since the Unix epoch
+    __slots__ = ('latitudes', 'longitudes', 'elevations', 'times')
+
+    def __init__(self, latitudes=None, longitudes=None, elevations=None, times=None):
+        self.latitudes = latitudes if latitudes is not None else array('d')
+        self.longitudes = longitudes if longitudes is not None else array('d')
+        self.elevations = elevations if elevations is not None else array('d')
+        self.times = times if times is not None else array('q')
+
+    @classmethod
+    def from_arrays(cls, latitudes, longitudes, elevations, times):
+        return cls(
+            array('d', latitudes.astype('float64').tobytes()),
+            array('d', longitudes.astype('float64').tobytes()),
+            array('d', elevations.astype('float64').tobytes()),
+            array('q', times.astype('int64').tobytes())
         )
+
+    @classmethod
+    def from_points(cls, track_points):
+        track = cls()
+        for latitude, longitude, elevation, time in track_points:
+            track.append(latitude, longitude, elevation, time)
+        return track
+
+    def append(self, latitude, longitude, elevation, time):
+        self.latitudes.append(latitude)
+        self.longitudes.append(longitude)
+        self.elevations.append(elevation)
+        self.times.append(to_epoch_us(time))
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        for latitude, longitude, elevation, time in zip(self.latitudes, self.longitudes, self.elevations, self.times):
+            yield latitude, longitude, elevation, EPOCH + timedelta(microseconds=time)
+
+def iter_track_blocks(track_points, chunk_size=3600):
+    track_points = iter(track_points)
+    for chunk in iter(lambda: list(islice(track_points, chunk_size)), []):
+        yield Track.from_points(chunk)
+
+# Track points are (latitude, longitude, elevation, time) tuples
+
+def arc(center_lat, center_lon, start_angle, stop_angle, current_time, time_end, get_elevation):
+    if current_time is None:
+        return None
+    ring = get_ring(center_lat, center_lon)
+    for angle in range(start_angle, stop_angle):
+        latitude, longitude = ring[angle]
+        yield latitude, longitude, get_elevation(angle), current_time
         current_time += timedelta(seconds=1)
         if (current_time > time_end):
             return None
     return current_time
 
-def circle(track_points, center_lat, center_lon, current_time, time_end, elevation):
-    return arc(track_points, center_lat, center_lon, 0, 360, current_time, time_end, lambda angle: elevation)
+def circle(center_lat, center_lon, current_time, time_end, elevation):
+    return (yield from arc(center_lat, center_lon, 0, 360, current_time, time_end, lambda angle: elevation))
 
-def up_and_down_circle(track_points, center_lat, center_lon, current_time, time_end, start_elevation, elevation_amplitude):
-    current_time = arc(track_points, center_lat, center_lon, 0, 90, current_time, time_end, lambda angle: start_elevation)
-    current_time = arc(track_points, center_lat, center_lon, 90, 180, current_time, time_end, lambda angle: start_elevation + elevation_amplitude * (angle-90)/90)
-    current_time = arc(track_points, center_lat, center_lon, 180, 270, current_time, time_end, lambda angle: start_elevation + elevation_amplitude)
-    current_time = arc(track_points, center_lat, center_lon, 270, 360, current_time, time_end, lambda angle: start_elevation + elevation_amplitude - elevation_amplitude * (angle-270)/90)
+def up_and_down_circle(center_lat, center_lon, current_time, time_end, start_elevation, elevation_amplitude):
+    current_time = yield from arc(center_lat, center_lon, 0, 90, current_time, time_end, lambda angle: start_elevation)
+    current_time = yield from arc(center_lat, center_lon, 90, 180, current_time, time_end, lambda angle: start_elevation + elevation_amplitude * (angle-90)/90)
+    current_time = yield from arc(center_lat, center_lon, 180, 270, current_time, time_end, lambda angle: start_elevation + elevation_amplitude)
+    current_time = yield from arc(center_lat, center_lon, 270, 360, current_time, time_end, lambda angle: start_elevation + elevation_amplitude - elevation_amplitude * (angle-270)/90)
     return current_time
 
+def iter_track_points(center_lat, center_lon, current_time, time_end, elevation, route_heights):
+    for route_height in route_heights:
+        current_time = yield from up_and_down_circle(center_lat, center_lon, current_time, time_end, elevation, route_height)
+
+    while current_time:
+        current_time = yield from circle(center_lat, center_lon, current_time, time_end, elevation)
+
+def get_track_point_count(current_time, time_end):
+    return max(1, (time_end - current_time) // timedelta(seconds=1) + 1)
+
+def get_track_arrays(center_lat, center_lon, elevation, route_heights, offsets):
+    # Same track as iter_track_points at the given offsets (in seconds from the start)
+    import numpy as np
+    angles = offsets % 360
+    laps = offsets // 360
+
+    ring = np.array(get_ring(center_lat, center_lon))
+    latitudes = ring[angles, 0]
+    longitudes = ring[angles, 1]
+
+    amplitudes = np.zeros(len(offsets))
+    in_route = laps < len(route_heights)
+    amplitudes[in_route] = np.array(route_heights, dtype=float)[laps[in_route]]
+
+    elevations = np.full(len(offsets), elevation, dtype=float)
+    up = (angles >= 90) & (angles < 180)
+    elevations[up] = elevation + amplitudes[up] * (angles[up] - 90) / 90
+    top = (angles >= 180) & (angles < 270)
+    elevations[top] = elevation + amplitudes[top]
+    down = angles >= 270
+    elevations[down] = elevation + amplitudes[down] - amplitudes[down] * (angles[down] - 270) / 90
+
+    return latitudes, longitudes, elevations
+
+def get_track_offsets(count, interval=1):
+    # Every interval seconds, always keeping the last point so the session keeps its duration
+    import numpy as np
+    offsets = np.arange(0, count, interval)
+    if offsets[-1] != count - 1:
+        offsets = np.append(offsets, count - 1)
+    return offsets
+
+def sample_track_points(track_points, interval=1):
+    index = -1
+    point = None
+    for index, point in enumerate(track_points):
+        if index % interval == 0:
+            yield point
+    if index % interval:
+        yield point
+
+def iter_track_numpy(center_lat, center_lon, current_time, time_end, elevation, route_heights, interval=1, chunk_size=3600):
+    offsets = get_track_offsets(get_track_point_count(current_time, time_end), interval)
+    start_time = to_epoch_us(current_time)
+    for start in range(0, len(offsets), chunk_size):
+        chunk = offsets[start:start + chunk_size]
+        latitudes, longitudes, elevations = get_track_arrays(center_lat, center_lon, elevation, route_heights, chunk)
+        yield Track.from_arrays(latitudes, longitudes, elevations, start_time + chunk * 1000000)
+
+def iter_track(center_lat, center_lon, current_time, time_end, elevation, route_heights, interval=1):
+    track_points = iter_track_points(center_lat, center_lon, current_time, time_end, elevation, route_heights)
+    return iter_track_blocks(sample_track_points(track_points, interval))
+
+# Engines yield Track blocks
+TRACK_ENGINES = {
+    'numpy': iter_track_numpy,
+    'python': iter_track
+}
+
+http_settings = {
+    'timeout': 30,
+    'retries': 5,
+    'backoff_factor': 1,
+    'pool_size': 10
+}
+http_sessions = {}
+http_lock = threading.Lock()
+# 429 responses of these hosts are left to their rate limiter instead of being retried
+RATE_LIMITED_HOSTS = {'www.strava.com'}
+# POST requests to these hosts are retried on connection errors and 5xx responses only,
+# after a read error the upload may have been created already
+POST_HOSTS = {'www.strava.com'}
+
+def get_http_session(url):
+    host = urlsplit(url).netloc
+    with http_lock:
+        if host not in http_sessions:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(
+                total=http_settings['retries'],
+                read=0 if host in POST_HOSTS else None,
+                other=0 if host in POST_HOSTS else None,
+                backoff_factor=http_settings['backoff_factor'],
+                status_forcelist=(500, 502, 503, 504) if host in RATE_LIMITED_HOSTS else (429, 500, 502, 503, 504),
+                allowed_methods=None if host in POST_HOSTS else Retry.DEFAULT_ALLOWED_METHODS,
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_maxsize=http_settings['pool_size'], max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            http_sessions[host] = session
+        return http_sessions[host]
+
+def http_request(method, url, **kwargs):
+    kwargs.setdefault('timeout', http_settings['timeout'])
+    response = get_http_session(url).request(method, url, **kwargs)
+    stats.count('http_requests')
+    retries = getattr(response.raw, 'retries', None)
+    if retries:
+        stats.count('http_retries', len(retries.history))
+    return response
+
+STRAVA_URL = 'https://www.strava.com'
+
+class RateLimitExceeded(Exception):
+    pass
+
+class RateLimiter:
+    # Strava counts the requests in 15 minutes windows starting on the quarter hours and in days starting at midnight UTC
+    WINDOWS = (900, 86400)
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.limits = None
+        self.usage = [0, 0]
+        self.updated_at = 0
+
+    def _load(self):
+        # Budget left by the previous runs
+        if not self.loaded and cache:
+            state = cache.get_rate_limit(self.name)
+            if state:
+                self.limits, self.usage, self.updated_at = state
+            self.loaded = True
+
+    def _current_usage(self, now):
+        return [
+            usage if now // window == self.updated_at // window else 0
+            for usage, window in zip(self.usage, self.WINDOWS)
+        ]
+
+    def _save(self):
+        if cache and self.limits:
+            cache.set_rate_limit(self.name, self.limits, self.usage, self.updated_at)
+
+    def acquire(self, wait=True):
+        while True:
+            with self.lock:
+                self._load()
+                now = time.time()
+                usage = self._current_usage(now)
+                if self.limits and usage[1] >= self.limits[1]:
+                    raise RateLimitExceeded(f"Daily limit of {self.limits[1]} requests reached")
+                if usage[0] < (self.limits[0] if self.limits else math.inf):
+                    self.usage = [value + 1 for value in usage]
+                    self.updated_at = now
+                    return
+                if not wait:
+                    raise RateLimitExceeded("15 minutes limit reached")
+                delay = self.WINDOWS[0] - now % self.WINDOWS[0]
+            stats.count('rate_limit_waits')
+            with stats.timer('rate_limit_wait'):
+                time.sleep(delay)
+
+    def update(self, response):
+        limits = response.headers.get('X-RateLimit-Limit')
+        usage = response.headers.get('X-RateLimit-Usage')
+        with self.lock:
+            now = time.time()
+            current_usage = self._current_usage(now)
+            if limits and usage:
+                self.limits = [int(value) for value in limits.split(',')[:2]]
+                # Requests still in flight are not counted by Strava yet
+                current_usage = [max(value, int(server_value)) for value, server_value in zip(current_usage, usage.split(',')[:2])]
+            if response.status_code == 429:
+                current_usage[0] = max(current_usage[0], self.limits[0] if self.limits else math.inf)
+            self.usage = current_usage
+            self.updated_at = now
+            self._save()
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(client_id):
+    # Strava counts the requests of each API application, accounts of the same application share their budget
+    with rate_limiters_lock:
+        if client_id not in rate_limiters:
+            rate_limiters[client_id] = RateLimiter(f'strava:{client_id}')
+        return rate_limiters[client_id]
+
+def strava_request(rate_limiter, method, path, wait=True, stage=None, **kwargs):
+    # The stage only times the requests, not the waits for the rate limiter
+    elapsed = 0
+    try:
+        while True:
+            rate_limiter.acquire(wait)
+            body = kwargs.get('data')
+            if hasattr(body, 'seek'):
+                body.seek(0)
+            start = time.perf_counter()
+            try:
+                response = http_request(method, f'{STRAVA_URL}{path}', **kwargs)
+            finally:
+                elapsed += time.perf_counter() - start
+            rate_limiter.update(response)
+            if response.status_code != 429:
+                return response
+            stats.count('rate_limited')
+    finally:
+        if stage and elapsed:
+            stats.record(stage, elapsed)
+
+def get_access_token(config):
+    response = http_request('POST', f'{STRAVA_URL}/oauth/token', data={
+        'client_id': config['client_id'],
+        'client_secret': config['client_secret'],
+        'refresh_token': config['refresh_token'],
+        'grant_type': 'refresh_token'
+    })
+    response.raise_for_status()
+    token = response.json()
+    config['refresh_token'] = token['refresh_token']
+    return token['access_token']
+
+class MultipartBody:
+    # multipart/form-data body read from a seekable file as it is sent, rewound on retries
+    def __init__(self, fields, file_field, file_name, file):
+        boundary = uuid4().hex
+        head = ''.join(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n' for name, value in fields.items())
+        head += f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{file_name}"\r\n\r\n'
+        tail = f'\r\n--{boundary}--\r\n'
+
+        file.seek(0, os.SEEK_END)
+        self.parts = [(BytesIO(head.encode()), len(head.encode())), (file, file.tell()), (BytesIO(tail.encode()), len(tail.encode()))]
+        self.length = sum(size for _, size in self.parts)
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(lambda: self.read(1 << 16), b'')
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=os.SEEK_SET):
+        self.position = position if whence == os.SEEK_SET else self.length + position
+        offset = self.position
+        for part, size in self.parts:
+            part.seek(min(max(offset, 0), size))
+            offset -= size
+        return self.position
+
+    def read(self, size=-1):
+        chunks = []
+        offset = self.position
+        for part, part_size in self.parts:
+            if offset >= part_size:
+                offset -= part_size
+                continue
+            chunk = part.read(part_size - offset if size < 0 else min(size, part_size - offset))
+            chunks.append(chunk)
+            self.position += len(chunk)
+            if size >= 0:
+                size -= len(chunk)
+                if size == 0:
+                    break
+            offset = 0
+        return b''.join(chunks)
+
+def upload_to_strava(access_token, rate_limiter, gpx, data_type='gpx'):
+    if isinstance(gpx, str):
+        gpx = BytesIO(gpx.encode())
+    body = MultipartBody({'data_type': data_type}, 'file', f'activity.{data_type}', gpx)
+    return strava_request(
+        rate_limiter,
+        'POST',
+        '/api/v3/uploads',
+        stage='upload',
+        headers={'Authorization': f'Bearer {access_token}', 'Content-Type': body.content_type},
+        data=body
+    )
+
+POLL_JOBS = 4
+
+class UploadPoller:
+    # Shared by the accounts of a batch, each upload is polled with the token and rate limiter of its account
+    def __init__(self, jobs=POLL_JOBS, min_interval=1, max_interval=30):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.uploads = {}
+        self.closed = False
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.pool = ThreadPoolExecutor(jobs)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _is_done(upload):
+        return bool(upload['error'] or upload['activity_id'])
+
+    def add(self, upload, label, access_token, rate_limiter):
+        with self.condition:
+            self.uploads[upload['id']] = {
+                **upload,
+                'label': label,
+                'access_token': access_token,
+                'rate_limiter': rate_limiter,
+                'interval': self.min_interval,
+                'next_poll': time.monotonic() + self.min_interval
+            }
+            self.condition.notify_all()
+
+    def _pending(self):
+        return [upload for upload in self.uploads.values() if not self._is_done(upload)]
+
+    def _poll(self, upload_id):
+        with self.condition:
+            upload = self.uploads[upload_id]
+            access_token, rate_limiter = upload['access_token'], upload['rate_limiter']
+        try:
+            response = strava_request(rate_limiter, 'GET', f'/api/v3/uploads/{upload_id}', wait=False, headers={'Authorization': f'Bearer {access_token}'})
+            response.raise_for_status()
+            result = response.json()
+        except Exception:
+            result = None
+
+        with self.condition:
+            upload = self.uploads[upload_id]
+            if result:
+                upload.update(status=result['status'], error=result['error'], activity_id=result['activity_id'])
+            # Back off while Strava is still processing
+            upload['interval'] = min(upload['interval'] * 2, self.max_interval)
+            upload['next_poll'] = time.monotonic() + upload['interval']
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if self.stopped:
+                    return
+                pending = self._pending()
+                if not pending:
+                    if self.closed:
+                        return
+                    self.condition.wait()
+                    continue
+                now = time.monotonic()
+                due = [upload['id'] for upload in pending if upload['next_poll'] <= now]
+                if not due:
+                    self.condition.wait(min(upload['next_poll'] for upload in pending) - now)
+                    continue
+            list(self.pool.map(self._poll, due))
+
+    def wait(self, timeout=None):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            self.condition.wait_for(lambda: not self._pending(), timeout)
+            uploads = [
+                {key: value for key, value in upload.items() if key not in ('access_token', 'rate_limiter')}
+                for upload in self.uploads.values()
+            ]
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.pool.shutdown()
+        return uploads
+
+def get_upload_summary(upload):
+    if upload['error']:
+        return f"error : {upload['error']}"
+    if upload['activity_id']:
+        return f"activity {upload['activity_id']}"
+    return f"pending : {upload['status']}"
+
+OPENTOPODATA_URL = 'https://api.opentopodata.org/v1'
+ELEVATION_DATASETS = ('eudem25m', 'mapzen')
+MISSING = object()
+
+class Cache:
+    def __init__(self, path, elevation_ttl=None):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.elevation_ttl = elevation_ttl
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS elevation ("
+                "latitude REAL, longitude REAL, dataset TEXT, elevation REAL, fetched_at REAL, "
+                "PRIMARY KEY (latitude, longitude, dataset))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS timezone ("
+                "location_id INTEGER, latitude REAL, longitude REAL, zone TEXT, "
+                "PRIMARY KEY (location_id, latitude, longitude))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit ("
+                "name TEXT PRIMARY KEY, short_limit INTEGER, daily_limit INTEGER, "
+                "short_usage INTEGER, daily_usage INTEGER, updated_at REAL)"
+            )
+
+    def get_elevation(self, lat, lon, dataset):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT elevation, fetched_at FROM elevation WHERE latitude = ? AND longitude = ? AND dataset = ?",
+                (round(lat, 5), round(lon, 5), dataset)
+            ).fetchone()
+            if row is None or (self.elevation_ttl is not None and time.time() - row[1] > self.elevation_ttl):
+                return MISSING
+            return row[0]
+
+    def set_elevation(self, lat, lon, dataset, elevation):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO elevation VALUES (?, ?, ?, ?, ?)",
+                (round(lat, 5), round(lon, 5), dataset, elevation, time.time())
+            )
+
+    def get_timezone(self, location_id, lat, lon):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT zone FROM timezone WHERE location_id = ? AND latitude = ? AND longitude = ?",
+                (location_id, lat, lon)
+            ).fetchone()
+            return row[0] if row else None
+
+    def set_timezone(self, location_id, lat, lon, zone):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO timezone VALUES (?, ?, ?, ?)",
+                (location_id, lat, lon, zone)
+            )
+
+    def get_rate_limit(self, name):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT short_limit, daily_limit, short_usage, daily_usage, updated_at FROM rate_limit WHERE name = ?",
+                (name,)
+            ).fetchone()
+            return (list(row[:2]), list(row[2:4]), row[4]) if row else None
+
+    def set_rate_limit(self, name, limits, usage, updated_at):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO rate_limit VALUES (?, ?, ?, ?, ?, ?)",
+                (name, *limits, *usage, updated_at)
+            )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+cache = None
+
+def open_cache(path, elevation_ttl=None):
+    global cache
+    cache = Cache(path, elevation_ttl)
+    return cache
+
+def get_cache_file(config_file):
+    return os.path.join(os.path.dirname(os.path.abspath(config_file)), 'ctb2strava.sqlite')
+
+def fetch_elevations(points, dataset):
+    params = {'locations': '|'.join(f'{lat},{lon}' for lat, lon in points)}
+    with stats.timer('elevation'):
+        response = http_request('GET', f'{OPENTOPODATA_URL}/{dataset}', params=params)
+        response.raise_for_status()
+        return [result['elevation'] for result in response.json()['results']]
+
 def get_elevation(lat, lon):
-   base_url = 'https://api.opentopodata.org/v1'
-   params = {'locations': f'{lat},{lon}'}
-   elevation = requests.get(f'{base_url}/eudem25m', params=params).json()['results'][0]['elevation']
-   if elevation:
-       return elevation
-   return requests.get(f'{base_url}/mapzen', params=params).json()['results'][0]['elevation']
-
-def get_gpx(session):
-    location = get_location(ctb, session)
-    routes = get_routes(ctb, session)
-
-    zone_info = ZoneInfo(TimezoneFinder().timezone_at(lat=location['latitude'], lng=location['longitude']))
+    for dataset in ELEVATION_DATASETS:
+        elevation = cache.get_elevation(lat, lon, dataset) if cache else MISSING
+        stats.count('elevation_cache_misses' if elevation is MISSING else 'elevation_cache_hits')
+        if elevation is MISSING:
+            elevation = fetch_elevations([(lat, lon)], dataset)[0]
+            if cache:
+                cache.set_elevation(lat, lon, dataset, elevation)
+        if elevation:
+            return elevation
+    return elevation
+
+timezone_settings = {
+    'in_memory': False
+}
+timezone_finder = None
+timezone_lock = threading.Lock()
+zone_infos = {}
+
+def get_timezone_name(lat, lon):
+    global timezone_finder
+    with timezone_lock:
+        if timezone_finder is None:
+            from timezonefinder import TimezoneFinder
+            timezone_finder = TimezoneFinder(in_memory=timezone_settings['in_memory'])
+        return timezone_finder.timezone_at(lat=lat, lng=lon)
+
+def get_zone_info(location):
+    key = (location['location_id'], location['latitude'], location['longitude'])
+    if key not in zone_infos:
+        zone = cache.get_timezone(*key) if cache else None
+        if zone is None:
+            stats.count('timezone_cache_misses')
+            with stats.timer('timezone'):
+                zone = get_timezone_name(location['latitude'], location['longitude'])
+            if cache:
+                cache.set_timezone(*key, zone)
+        else:
+            stats.count('timezone_cache_hits')
+        zone_infos[key] = ZoneInfo(zone)
+    else:
+        stats.count('timezone_cache_hits')
+    return zone_infos[key]
+
+def prefetch_elevations(points, batch_size=100):
+    pending = list(dict.fromkeys(points))
+    for dataset in ELEVATION_DATASETS:
+        elevations = {point: cache.get_elevation(*point, dataset) for point in pending}
+        missing = [point for point, elevation in elevations.items() if elevation is MISSING]
+        # Counted apart from the lookups of get_elevation, which find the prefetched points
+        if len(elevations) > len(missing):
+            stats.count('prefetch_cache_hits', len(elevations) - len(missing))
+        if missing:
+            stats.count('prefetch_cache_misses', len(missing))
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            for point, elevation in zip(batch, fetch_elevations(batch, dataset)):
+                cache.set_elevation(*point, dataset, elevation)
+                elevations[point] = elevation
+        # Only the points without data go to the next dataset
+        pending = [point for point, elevation in elevations.items() if not elevation]
+
+def escape(text):
+    # As xml.sax.saxutils.escape, which imports urllib.request
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+GPX_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<gpx version="1.1" creator="ctb2strava" xmlns="http://www.topografix.com/GPX/1/1">\n'
+    ' <trk>\n'
+    '  <name>{name}</name>\n'
+    '  <desc>{description}</desc>\n'
+    '  <type>{activity_type}</type>\n'
+    '  <trkseg>\n'
+)
+GPX_TRACK_POINT = '   <trkpt lat="{}" lon="{}"><ele>{}</ele><time>{}</time></trkpt>\n'
+GPX_FOOTER = (
+    '  </trkseg>\n'
+    ' </trk>\n'
+    '</gpx>\n'
+)
+
+@lru_cache(maxsize=16)
+def format_gpx_date(day):
+    return (EPOCH + timedelta(days=day)).strftime('%Y-%m-%dT')
+
+def format_gpx_time(time):
+    # Same as isoformat() in UTC with a Z suffix, from microseconds since the Unix epoch
+    day, microseconds = divmod(time, 86400000000)
+    seconds, microseconds = divmod(microseconds, 1000000)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if microseconds:
+        return f"{format_gpx_date(day)}{hours:02d}:{minutes:02d}:{seconds:02d}.{microseconds:06d}Z"
+    return f"{format_gpx_date(day)}{hours:02d}:{minutes:02d}:{seconds:02d}Z"
+
+def write_gpx(file, name, description, activity_type, tracks, precision=None):
+    # Writes Track blocks to a binary file as they are generated, coordinates rounded to precision decimals
+    coordinate_format = '{}' if precision is None else f'{{:.{precision}f}}'
+    track_point_format = GPX_TRACK_POINT.format(coordinate_format, coordinate_format, '{}', '{}').format
+
+    file.write(GPX_HEADER.format(name=escape(name), description=escape(description), activity_type=escape(activity_type)).encode())
+    for track in tracks:
+        file.write(''.join(
+            track_point_format(latitude, longitude, elevation, format_gpx_time(time))
+            for latitude, longitude, elevation, time in zip(track.latitudes, track.longitudes, track.elevations, track.times)
+        ).encode())
+    file.write(GPX_FOOTER.encode())
+
+def write_session_gpx(file, backup, session, engine='numpy', renderer=None, interval=1, precision=None):
+    location = get_location(backup, session)
+    routes = get_routes(backup, session)
+
+    zone_info = get_zone_info(location)
     current_time = datetime.fromisoformat(session['time_start']).replace(tzinfo=zone_info).astimezone(timezone.utc)
     time_end = datetime.fromisoformat(session['time_end']).replace(tzinfo=zone_info).astimezone(timezone.utc)
     elevation = get_elevation(location['latitude'], location['longitude'])
 
-    track_points = []
+    tracks = TRACK_ENGINES[engine](location['latitude'], location['longitude'], current_time, time_end, elevation, [get_route_height(route) for route in routes], interval)
 
-    for route in routes:
-        current_time = up_and_down_circle(track_points, location['latitude'], location['longitude'], current_time, time_end, elevation, get_route_height(route))
+    with stats.timer('description'):
+        description = get_description(session, routes, renderer)
 
-    while current_time:
-        current_time = circle(track_points, location['latitude'], location['longitude'], current_time, time_end, elevation)
-
-    return gpx2strava.get_gpx(
+    # Generation and serialization are interleaved, the generation time is measured per block
+    track_durations = []
+    start = time.perf_counter()
+    write_gpx(
+        file,
         get_title(location),
-        get_description(session, routes),
+        description,
         'RockClimbing',
-        track_points
+        timed(tracks, track_durations),
+        precision
     )
+    track_duration = sum(track_durations)
+    stats.record('track', track_duration)
+    stats.record('serialization', time.perf_counter() - start - track_duration)
+
+def get_gpx_file(backup, session, compress_level=0, **options):
+    # Kept in memory up to 1 MB, then spooled to disk, gzipped unless compress_level is 0
+    file = SpooledTemporaryFile(max_size=1 << 20)
+    if compress_level:
+        with gzip.GzipFile(fileobj=file, mode='wb', compresslevel=compress_level, mtime=0) as gzip_file:
+            write_session_gpx(gzip_file, backup, session, **options)
+    else:
+        write_session_gpx(file, backup, session, **options)
+    file.seek(0)
+    return file
+
+def get_gpx(backup, session, **options):
+    file = BytesIO()
+    write_session_gpx(file, backup, session, **options)
+    return file.getvalue().decode()
+
+def export_sessions(sessions, build_gpx, upload_gpx, jobs=1):
+    # Yields (session, response, error) in session order and stops scheduling after the first failure
+    with ThreadPoolExecutor(jobs) as build_pool, ThreadPoolExecutor(jobs) as upload_pool:
+        def build_and_upload(session):
+            return upload_pool.submit(upload_gpx, session, build_gpx(session))
+
+        sessions = iter(sessions)
+        pending = deque()
+        failed = False
+        while True:
+            while not failed and len(pending) < 2 * jobs:
+                session = next(sessions, None)
+                if session is None:
+                    break
+                pending.append((session, build_pool.submit(build_and_upload, session)))
+            if not pending:
+                return
+
+            session, future = pending.popleft()
+            try:
+                response, error = future.result().result(), None
+            except Exception as e:
+                response, error = None, e
+            failed = failed or error is not None or not response.ok
+            yield session, response, error
+
+worker_state = {}
+
+def init_export_worker(backup, cache_file, settings):
+    worker_state['backup'] = backup
+    http_settings.update(settings['http'])
+    timezone_settings.update(settings['timezone'])
+    open_cache(cache_file)
+
+def export_gpx(session, path, options):
+    with stats.session(session):
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'wb') as file:
+            write_session_gpx(file, worker_state['backup'], session, **options)
+        os.replace(temporary_path, path)
+    with stats.lock:
+        return stats.sessions.pop(session['session_id'], {})
+
+def get_export_file_name(session):
+    return f"{datetime.fromisoformat(session['time_start']):%Y-%m-%d_%H-%M-%S}_{session['session_id']}.gpx"
+
+def export_gpx_files(backup, sessions, directory, cache_file, jobs=1, **options):
+    # Yields (session, path, error) in session order, sessions whose file exists are skipped
+    os.makedirs(directory, exist_ok=True)
+    paths = [os.path.join(directory, get_export_file_name(session)) for session in sessions]
+    pending = [(session, path) for session, path in zip(sessions, paths) if not os.path.exists(path)]
+    if not pending:
+        return
+
+    # Workers only read the elevations and timezones from the cache
+    locations = [get_location(backup, session) for session, _ in pending]
+    prefetch_elevations([(location['latitude'], location['longitude']) for location in locations])
+    for location in locations:
+        get_zone_info(location)
+
+    from concurrent.futures import ProcessPoolExecutor
+    settings = {'http': http_settings, 'timezone': timezone_settings}
+    with ProcessPoolExecutor(jobs, initializer=init_export_worker, initargs=(backup, cache_file, settings)) as pool:
+        futures = [pool.submit(export_gpx, session, path, options) for session, path in pending]
+        for (session, path), future in zip(pending, futures):
+            try:
+                timings = future.result()
+            except Exception as e:
+                yield session, path, e
+                continue
+            with stats.session(session):
+                for stage, seconds in timings.items():
+                    stats.record(stage, seconds)
+            yield session, path, None
+
+def write_file(path, text):
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+
+def write_atomically(path, text):
+    temporary_path = f"{path}.tmp"
+    write_file(temporary_path, text)
+    try:
+        os.replace(temporary_path, path)
+    except OSError as e:
+        # A file bind-mounted in a container cannot be replaced, it is rewritten in place
+        if e.errno not in (errno.EBUSY, errno.EXDEV):
+            raise
+        os.remove(temporary_path)
+        write_file(path, text)
+
+def load_json(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+def save_json(path, data):
+    write_atomically(path, json.dumps(data, indent=2))
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        text = ''
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                text = file.read()
+            for line in text.splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line torn by a crash
+                    continue
+                self.entries[entry['session_id']] = entry
+        self.file = open(path, 'a', encoding='utf-8')
+        if text and not text.endswith('\n'):
+            self.file.write('\n')
+
+    def is_uploaded(self, session):
+        entry = self.entries.get(session['session_id'])
+        return entry is not None and entry['status'] == 'uploaded'
+
+    def record(self, session, status, upload_id=None):
+        entry = {
+            'session_id': session['session_id'],
+            'time_start': session['time_start'],
+            'status': status,
+            'upload_id': upload_id
+        }
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.entries[entry['session_id']] = entry
+
+    def compact(self, last_export):
+        # Sessions up to the watermark no longer need an entry
+        last_export = datetime.fromisoformat(last_export)
+        with self.lock:
+            self.file.close()
+            self.entries = {
+                session_id: entry
+                for session_id, entry in self.entries.items()
+                if datetime.fromisoformat(entry['time_start']) > last_export
+            }
+            write_atomically(self.path, ''.join(json.dumps(entry) + '\n' for entry in self.entries.values()))
+            self.file = open(self.path, 'a', encoding='utf-8')
+
+    def merge(self, other):
+        for entry in other.entries.values():
+            if entry['status'] == 'uploaded' and not self.is_uploaded(entry):
+                self.record(entry, entry['status'], entry['upload_id'])
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def advance_last_export(config, sessions, journal):
+    # The watermark only moves past the sessions before the first one not uploaded
+    for session in sessions:
+        if not journal.is_uploaded(session):
+            break
+        config['last_export'] = session['time_start']
+
+def parse_jobs(text):
+    jobs = int(text)
+    if jobs < 1:
+        raise ValueError(f"Invalid number of jobs {text}")
+    return jobs
+
+def parse_shard(text):
+    index, count = (int(value) for value in text.split('/'))
+    if not 1 <= index <= count:
+        raise ValueError(f"Invalid shard {text}")
+    return index, count
+
+def get_shard(session, count):
+    # Stable across runs and machines, unlike hash()
+    return zlib.crc32(str(session['session_id']).encode()) % count + 1
+
+def get_shard_journal_file(config_file, index, count):
+    return f"{config_file}.shard-{index}-of-{count}.journal"
+
+def export_account(config_file, ctb_file, args, cache_file, gpx_options, export_dir=None, poller=None):
+    # Caches, connection pools and rate limits are shared by all the accounts of the process
+    config = load_json(config_file)
+
+    if args.stream:
+        backup = index_backup(stream_backup(ctb_file, config['last_export']))
+    else:
+        backup = index_backup(load_json(ctb_file))
+    sessions = get_new_sessions(backup, config['last_export'])
+    journal_file = f"{config_file}.journal"
+
+    if args.merge_shards:
+        journal = Journal(journal_file)
+        for index in range(1, args.merge_shards + 1):
+            shard_journal_file = get_shard_journal_file(config_file, index, args.merge_shards)
+            if os.path.exists(shard_journal_file):
+                shard_journal = Journal(shard_journal_file)
+                journal.merge(shard_journal)
+                shard_journal.close()
+                os.remove(shard_journal_file)
+        advance_last_export(config, sessions, journal)
+        save_json(config_file, config)
+        journal.compact(config['last_export'])
+        journal.close()
+        print(f"{ctb_file} : last_export {config['last_export']}")
+        return
+
+    if args.shard:
+        shard_index, shard_count = args.shard
+        sessions = [session for session in sessions if get_shard(session, shard_count) == shard_index]
+    if not sessions:
+        print(f"{ctb_file} : No session found")
+        return
+
+    if export_dir:
+        for session, path, error in export_gpx_files(backup, sessions, export_dir, cache_file, args.jobs or os.cpu_count(), **gpx_options):
+            print(f"{ctb_file} : {session['time_start']} : {repr(error) if error else path}")
+        return
+
+    if args.shard:
+        # Sessions already merged from a previous sharded run are not uploaded again
+        merged_journal = Journal(journal_file)
+        sessions = [session for session in sessions if not merged_journal.is_uploaded(session)]
+        merged_journal.close()
+        journal = Journal(get_shard_journal_file(config_file, *args.shard))
+    else:
+        journal = Journal(journal_file)
+    # Sessions uploaded by a previous run that did not complete are not uploaded again
+    pending_sessions = [session for session in sessions if not journal.is_uploaded(session)]
+
+    locations = [get_location(backup, session) for session in pending_sessions]
+    prefetch_elevations([(location['latitude'], location['longitude']) for location in locations])
+
+    access_token = get_access_token(config)
+    save_json(config_file, config)
+    rate_limiter = get_rate_limiter(config['client_id'])
+
+    def build(session):
+        with stats.session(session):
+            return get_gpx_file(backup, session, args.gzip_level, **gpx_options)
+
+    def upload(session, gpx):
+        with gpx, stats.session(session):
+            response = upload_to_strava(access_token, rate_limiter, gpx, 'gpx.gz' if args.gzip_level else 'gpx')
+        if response.ok:
+            journal.record(session, 'uploaded', response.json()['id'])
+        else:
+            journal.record(session, 'failed')
+        return response
+
+    for session, response, error in export_sessions(
+        pending_sessions,
+        build,
+        upload,
+        args.jobs or 1
+    ):
+        if isinstance(error, RateLimitExceeded):
+            print(f"{ctb_file} : {session['time_start']} : deferred to the next run : {error}")
+            journal.record(session, 'deferred')
+        elif error:
+            print(f"{ctb_file} : {session['time_start']} : {error!r}")
+            journal.record(session, 'failed')
+        else:
+            print(f"{ctb_file} : {response.status_code} : {response.text}")
+            if poller and response.ok:
+                poller.add(response.json(), f"{ctb_file} : {session['time_start']}", access_token, rate_limiter)
+
+    if not args.shard:
+        advance_last_export(config, sessions, journal)
+        save_json(config_file, config)
+        journal.compact(config['last_export'])
+    journal.close()
+
+def load_manifest(path):
+    # Paths are relative to the manifest
+    directory = os.path.dirname(os.path.abspath(path))
+    return [
+        {
+            'name': entry.get('name') or os.path.basename(os.path.dirname(os.path.join(directory, entry['config']))),
+            'config': os.path.join(directory, entry['config']),
+            'ctb': os.path.join(directory, entry['ctb'])
+        }
+        for entry in load_json(path)
+    ]
 
 
 if __name__ == "__main__":
     import argparse
-    import sys
 
     parser = argparse.ArgumentParser(description='Create activities on Strava from a Climbing Tracker backups')
     parser.add_argument('config_file', nargs='?', help='Config file')
     parser.add_argument('ctb_file', nargs='?', help='Climbing Tracker backup file')
+    parser.add_argument('--batch', metavar='MANIFEST', help='JSON list of {"config", "ctb"} files (and an optional "name") exported in turn by this process')
+    parser.add_argument('--stream', action='store_true', help='Stream the backup file and only keep the sessions to export')
+    parser.add_argument('--engine', choices=TRACK_ENGINES, default='numpy', help='Track generation engine')
+    parser.add_argument('--sample-interval', type=int, choices=range(1, 91), default=1, metavar='{1-90}', help='Seconds (and degrees of the circle) between two track points')
+    parser.add_argument('--precision', type=int, choices=range(16), metavar='{0-15}', help='Decimals of the track point coordinates')
+    parser.add_argument('--description-template', help='JSON file overriding fragments of the description template')
+    parser.add_argument('--gzip-level', type=int, choices=range(10), default=6, metavar='{0-9}', help='Compression level of the uploaded GPX files (0 to upload them uncompressed)')
+    parser.add_argument('--cache', help='Cache file (default: ctb2strava.sqlite next to the config or manifest file)')
+    parser.add_argument('--elevation-ttl', type=float, help='Days after which cached elevations are fetched again')
+    parser.add_argument('--timezone-in-memory', action='store_true', help='Load the timezone data in memory')
+    parser.add_argument('--jobs', type=parse_jobs, help='Number of sessions built and uploaded concurrently (default: 1), or exported concurrently (default: number of CPUs)')
+    parser.add_argument('--export-dir', help='Write one GPX file per session in this directory instead of uploading them')
+    parser.add_argument('--shard', type=parse_shard, metavar='i/N', help='Only export the sessions of the i-th of N shards, with its own journal and without updating last_export')
+    parser.add_argument('--merge-shards', type=int, metavar='N', help='Merge the journals of N shards and update last_export')
+    parser.add_argument('--poll-timeout', type=float, default=300, help='Seconds to wait for Strava to process the uploads (0 to skip)')
+    parser.add_argument('--metrics-json', help='JSON file receiving the timings and counters of the run')
+    parser.add_argument('--metrics-prometheus', help='Prometheus textfile receiving the timings and counters of the run')
+    parser.add_argument('--timeout', type=float, default=http_settings['timeout'], help='HTTP timeout in seconds')
+    parser.add_argument('--retries', type=int, default=http_settings['retries'], help='HTTP retries on 429 and 5xx responses, with exponential backoff')
 
     args = parser.parse_args()
-    if args.config_file and args.ctb_file:
-        config = utils.load_json(args.config_file)
-
-        ctb = utils.load_json(args.ctb_file)
-        sessions = get_new_sessions(ctb, config['last_export'])
-        if not sessions:
-            print("No session found")
-            sys.exit()
-
-        access_token = gpx2strava.get_access_token(config)
-        for session in sessions:
-            response = gpx2strava.upload_to_strava(access_token, get_gpx(session))
-            print(f"{args.ctb_file} : {response.status_code} : {response.text}")
-        
-        config['last_export'] = sessions[-1]['time_start']
-        utils.save_json(args.config_file, config)
+    http_settings['timeout'] = args.timeout
+    http_settings['retries'] = args.retries
+    # One connection per concurrent upload and poll, set before the first session is created
+    http_settings['pool_size'] = max(http_settings['pool_size'], (args.jobs or 1) + POLL_JOBS)
+    timezone_settings['in_memory'] = args.timezone_in_memory
+
+    if args.batch or (args.config_file and args.ctb_file):
+        cache_file = args.cache or get_cache_file(args.batch or args.config_file)
+        open_cache(cache_file, args.elevation_ttl * 86400 if args.elevation_ttl is not None else None)
+
+        gpx_options = {
+            'engine': args.engine,
+            'renderer': DescriptionRenderer(load_json(args.description_template) if args.description_template else None),
+            'interval': args.sample_interval,
+            'precision': args.precision
+        }
+
+        # Uploads are polled while the next sessions and accounts are uploaded
+        poller = UploadPoller() if args.poll_timeout and not args.export_dir else None
+
+        if args.batch:
+            for account in load_manifest(args.batch):
+                try:
+                    export_account(
+                        account['config'],
+                        account['ctb'],
+                        args,
+                        cache_file,
+                        gpx_options,
+                        os.path.join(args.export_dir, account['name']) if args.export_dir else None,
+                        poller
+                    )
+                except Exception as e:
+                    # One account failing does not stop the others
+                    print(f"{account['ctb']} : {e!r}")
+        else:
+            export_account(args.config_file, args.ctb_file, args, cache_file, gpx_options, args.export_dir, poller)
+
+        if poller:
+            for upload in poller.wait(args.poll_timeout):
+                print(f"{upload['label']} : {get_upload_summary(upload)}")
+
+        summary = stats.format_summary()
+        if summary:
+            print(summary)
+        if args.metrics_json:
+            save_json(args.metrics_json, stats.summary())
+        if args.metrics_prometheus:
+            write_atomically(args.metrics_prometheus, stats.format_prometheus())
+        cache.close()
     else:
         parser.print_help()
@@ -0,0 +1,56 @@
+import base64
+import json
+import os
+import sys
+
+import requests
+from gpx2strava import gpx2strava
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ctb2strava
+from test_gpx import BACKUP, SESSION, REFERENCE_GPX, REFERENCE_UPLOAD, get_track_points, open_offline_cache
+
+
+def capture_upload(gpx):
+    # The request of gpx2strava is prepared but not sent
+    sent = []
+
+    def request(method, url, **kwargs):
+        sent.append(requests.Request(method.upper(), url, **kwargs).prepare())
+        raise RuntimeError("Not sent")
+
+    requests.api.request = request
+    requests.Session.request = lambda self, method, url, **kwargs: request(method, url, **kwargs)
+    try:
+        gpx2strava.upload_to_strava('token', gpx)
+    except RuntimeError:
+        pass
+    return sent[0]
+
+
+if __name__ == "__main__":
+    cache = open_offline_cache()
+    location = ctb2strava.get_location(BACKUP, SESSION)
+    gpx = gpx2strava.get_gpx(
+        ctb2strava.get_title(location),
+        ctb2strava.get_description(SESSION, ctb2strava.get_routes(BACKUP, SESSION)),
+        'RockClimbing',
+        [gpx2strava.TrackPoint(*point) for point in get_track_points()]
+    )
+    # The upload body is built from the GPX of ctb2strava, as the one sent by upload_to_strava
+    request = capture_upload(ctb2strava.get_gpx(BACKUP, SESSION, engine='python'))
+    cache.close()
+
+    os.makedirs(os.path.dirname(REFERENCE_GPX), exist_ok=True)
+    with open(REFERENCE_GPX, 'w', encoding='utf-8') as file:
+        file.write(gpx)
+    with open(REFERENCE_UPLOAD, 'w', encoding='utf-8') as file:
+        json.dump({
+            'method': request.method,
+            'url': request.url,
+            'authorization': request.headers['Authorization'],
+            'content_type': request.headers['Content-Type'],
+            'body': base64.b64encode(request.body).decode()
+        }, file, indent=2)
+    print(f"Fixtures written to {os.path.dirname(REFERENCE_GPX)}")
@@ -0,0 +1,27 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ctb2strava
+
+
+DOCUMENT = {
+    'version': 1.5e10,
+    'ratio': -2.25E-3,
+    'count': 12345,
+    'sessions': [1.5, -0.5e+2, 7, True, None, {'a': 1.25, 'b': "x\"y"}],
+    'routes': [],
+    'locations': [[1, 2.5], "12e3"],
+    'last': 3
+}
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 16, 1 << 16])
+def test_iter_json_arrays(tmp_path, chunk_size):
+    path = tmp_path / 'ctb.json'
+    path.write_text(json.dumps(DOCUMENT))
+    items = list(ctb2strava.iter_json_arrays(path, chunk_size))
+    assert items == [(key, item) for key, value in DOCUMENT.items() if isinstance(value, list) for item in value]
@@ -0,0 +1,181 @@
+import argparse
+import errno
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ctb2strava
+
+
+LOCATION = {'location_id': 1, 'location_name': "Salle & Co <Lausanne>", 'location_outdoor': 0, 'latitude': 46.5365, 'longitude': 6.5872}
+BACKUP = {
+    'locations': [LOCATION],
+    'sessions': [
+        {'session_id': index, 'location_id': 1, 'time_start': f'2023-03-0{index}T18:00:00.000', 'time_end': f'2023-03-0{index}T19:30:00.000', 'session_comment': f"Session {index}"}
+        for index in range(1, 5)
+    ],
+    'routes': [
+        {'route_id': index, 'session_id': index, 'ascend_order': 0, 'route_type': 'SPORT_CLIMBING', 'route_name': "", 'comment': "", 'ascend_height': 18, 'top_rope': 0, 'speed_type': 1, 'speed_time': 0, 'style_id': 3, 'grade_id': 1000, 'original_grade_system': None}
+        for index in range(1, 5)
+    ]
+}
+LAST_EXPORT = '2000-01-01T00:00:00.000'
+
+@pytest.fixture(autouse=True)
+def offline_cache(monkeypatch):
+    # Elevation and timezone of the location are cached, no network call is made
+    cache = ctb2strava.open_cache(':memory:')
+    for dataset in ctb2strava.ELEVATION_DATASETS:
+        cache.set_elevation(LOCATION['latitude'], LOCATION['longitude'], dataset, 432.5)
+    cache.set_timezone(LOCATION['location_id'], LOCATION['latitude'], LOCATION['longitude'], 'Europe/Zurich')
+    monkeypatch.setattr(ctb2strava, 'rate_limiters', {})
+    yield
+    cache.close()
+    ctb2strava.cache = None
+
+@pytest.fixture
+def account(tmp_path):
+    config_file = tmp_path / 'config.json'
+    config_file.write_text(json.dumps({'client_id': 1, 'client_secret': 'secret', 'refresh_token': 'refresh', 'last_export': LAST_EXPORT}))
+    ctb_file = tmp_path / 'ctb.json'
+    ctb_file.write_text(json.dumps(BACKUP))
+    return str(config_file), str(ctb_file)
+
+class Response:
+    headers = {}
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.ok = status_code < 400
+        self.text = json.dumps(content)
+
+    def json(self):
+        return self.content
+
+    def raise_for_status(self):
+        assert self.ok
+
+def fake_strava(monkeypatch, failing=()):
+    # Session ids of the uploads received, the session is found from its comment in the description
+    uploads = []
+
+    def http_request(method, url, **kwargs):
+        if url.endswith('/oauth/token'):
+            return Response(200, {'access_token': 'token', 'refresh_token': 'rotated'})
+        body = kwargs['data'].read()
+        session_id = next(session['session_id'] for session in BACKUP['sessions'] if session['session_comment'].encode() in body)
+        uploads.append(session_id)
+        if session_id in failing:
+            return Response(500, {'error': "Server error"})
+        return Response(201, {'id': 100 + session_id, 'status': "Your activity is still being processed.", 'error': None, 'activity_id': None})
+
+    monkeypatch.setattr(ctb2strava, 'http_request', http_request)
+    return uploads
+
+def export(config_file, ctb_file, shard=None, merge_shards=None):
+    args = argparse.Namespace(stream=False, shard=shard, merge_shards=merge_shards, jobs=2, gzip_level=0)
+    ctb2strava.export_account(config_file, ctb_file, args, ':memory:', {'engine': 'python'})
+    return ctb2strava.load_json(config_file)
+
+def test_write_atomically(tmp_path):
+    path = tmp_path / 'config.json'
+    path.write_text('{}')
+    ctb2strava.write_atomically(path, '{"last_export": "2023-01-01T00:00:00.000"}')
+    assert path.read_text() == '{"last_export": "2023-01-01T00:00:00.000"}'
+    assert os.listdir(tmp_path) == ['config.json']
+
+def test_write_atomically_bind_mount(tmp_path, monkeypatch):
+    def replace(source, destination):
+        raise OSError(errno.EBUSY, "Device or resource busy")
+
+    monkeypatch.setattr(os, 'replace', replace)
+    path = tmp_path / 'config.json'
+    path.write_text('{}')
+    ctb2strava.write_atomically(path, '{"refresh_token": "rotated"}')
+    assert path.read_text() == '{"refresh_token": "rotated"}'
+    assert os.listdir(tmp_path) == ['config.json']
+
+def test_journal_torn_line(tmp_path):
+    path = tmp_path / 'config.json.journal'
+    path.write_text('{"session_id": 1, "time_start": "2023-03-01T18:00:00.000", "status": "uploaded", "upload_id": 101}\n{"session_id": 2, "time_')
+    journal = ctb2strava.Journal(path)
+    assert list(journal.entries) == [1]
+    journal.record(BACKUP['sessions'][1], 'uploaded', 102)
+    journal.close()
+    journal = ctb2strava.Journal(path)
+    assert journal.is_uploaded(BACKUP['sessions'][0]) and journal.is_uploaded(BACKUP['sessions'][1])
+    journal.close()
+
+def test_journal_compact(tmp_path):
+    path = tmp_path / 'config.json.journal'
+    journal = ctb2strava.Journal(path)
+    for session in BACKUP['sessions']:
+        journal.record(session, 'uploaded', 100 + session['session_id'])
+    journal.compact(BACKUP['sessions'][1]['time_start'])
+    journal.record(BACKUP['sessions'][0], 'uploaded', 101)
+    journal.close()
+    assert [json.loads(line)['session_id'] for line in path.read_text().splitlines()] == [3, 4, 1]
+
+def test_journal_merge(tmp_path):
+    journal = ctb2strava.Journal(tmp_path / 'config.json.journal')
+    journal.record(BACKUP['sessions'][0], 'uploaded', 101)
+    shard_journal = ctb2strava.Journal(tmp_path / 'config.json.shard-1-of-2.journal')
+    shard_journal.record(BACKUP['sessions'][0], 'uploaded', 101)
+    shard_journal.record(BACKUP['sessions'][1], 'uploaded', 102)
+    shard_journal.record(BACKUP['sessions'][2], 'failed')
+    journal.merge(shard_journal)
+    shard_journal.close()
+    journal.close()
+    assert [json.loads(line)['session_id'] for line in (tmp_path / 'config.json.journal').read_text().splitlines()] == [1, 2]
+
+def test_advance_last_export(tmp_path):
+    journal = ctb2strava.Journal(tmp_path / 'config.json.journal')
+    sessions = BACKUP['sessions']
+    config = {'last_export': LAST_EXPORT}
+    ctb2strava.advance_last_export(config, sessions, journal)
+    assert config['last_export'] == LAST_EXPORT
+    journal.record(sessions[0], 'uploaded', 101)
+    journal.record(sessions[1], 'failed')
+    journal.record(sessions[2], 'uploaded', 103)
+    ctb2strava.advance_last_export(config, sessions, journal)
+    assert config['last_export'] == sessions[0]['time_start']
+    journal.record(sessions[1], 'uploaded', 102)
+    ctb2strava.advance_last_export(config, sessions, journal)
+    assert config['last_export'] == sessions[2]['time_start']
+    journal.close()
+
+def test_export_account_resumes_after_failure(monkeypatch, account):
+    config_file, ctb_file = account
+    # All the sessions are scheduled before the second one fails
+    uploads = fake_strava(monkeypatch, failing={2})
+    config = export(config_file, ctb_file)
+    assert sorted(uploads) == [1, 2, 3, 4]
+    assert config['last_export'] == BACKUP['sessions'][0]['time_start']
+    assert config['refresh_token'] == 'rotated'
+
+    uploads = fake_strava(monkeypatch)
+    config = export(config_file, ctb_file)
+    assert uploads == [2]
+    assert config['last_export'] == BACKUP['sessions'][-1]['time_start']
+    assert os.path.getsize(f'{config_file}.journal') == 0
+
+def test_export_account_shards(monkeypatch, account):
+    config_file, ctb_file = account
+    uploads = fake_strava(monkeypatch)
+    for index in (1, 2):
+        config = export(config_file, ctb_file, shard=(index, 2))
+        assert config['last_export'] == LAST_EXPORT
+    assert sorted(uploads) == [1, 2, 3, 4]
+
+    config = export(config_file, ctb_file, merge_shards=2)
+    assert config['last_export'] == BACKUP['sessions'][-1]['time_start']
+    assert sorted(os.listdir(os.path.dirname(config_file))) == ['config.json', 'config.json.journal', 'ctb.json']
+
+    uploads = fake_strava(monkeypatch)
+    export(config_file, ctb_file)
+    assert uploads == []
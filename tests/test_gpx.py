@@ -0,0 +1,154 @@
+import base64
+from datetime import datetime, timezone
+from email.parser import BytesParser
+import gzip
+import json
+import os
+import sys
+from xml.etree import ElementTree
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ctb2strava
+
+
+ELEVATION = 432.5
+# Reference GPX and upload of gpx2strava 2.0.0, written by make_gpx2strava_fixtures.py
+REFERENCE_GPX = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'gpx2strava.gpx')
+REFERENCE_UPLOAD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'gpx2strava_upload.json')
+
+BACKUP = ctb2strava.index_backup({
+    'locations': [
+        {'location_id': 1, 'location_name': "Salle & Co <Lausanne>", 'location_outdoor': 0, 'latitude': 46.5365, 'longitude': 6.5872}
+    ],
+    'sessions': [
+        {'session_id': 1, 'location_id': 1, 'time_start': '2023-03-26T01:50:00.000', 'time_end': '2023-03-26T03:20:30.000', 'session_comment': "Good session"}
+    ],
+    'routes': [
+        {'route_id': 1, 'session_id': 1, 'ascend_order': 0, 'route_type': 'SPORT_CLIMBING', 'route_name': "", 'comment': "", 'ascend_height': 18, 'top_rope': 0, 'speed_type': 1, 'speed_time': 0, 'style_id': 3, 'grade_id': 1000, 'original_grade_system': None},
+        {'route_id': 2, 'session_id': 1, 'ascend_order': 1, 'route_type': 'BOULDER', 'route_name': "Crimps", 'comment': "Nice one", 'ascend_height': 0, 'top_rope': 0, 'speed_type': 1, 'speed_time': 0, 'style_id': 101, 'grade_id': 11400, 'original_grade_system': 'V-Scale'}
+    ]
+})
+SESSION = BACKUP['sessions'][0]
+
+def open_offline_cache():
+    # Elevation and timezone of the location are cached, no network call is made
+    location = BACKUP['locations'][1]
+    cache = ctb2strava.open_cache(':memory:')
+    for dataset in ctb2strava.ELEVATION_DATASETS:
+        cache.set_elevation(location['latitude'], location['longitude'], dataset, ELEVATION)
+    cache.set_timezone(location['location_id'], location['latitude'], location['longitude'], 'Europe/Zurich')
+    return cache
+
+@pytest.fixture(autouse=True)
+def offline_cache():
+    cache = open_offline_cache()
+    yield
+    cache.close()
+    ctb2strava.cache = None
+
+def get_track_points():
+    location = ctb2strava.get_location(BACKUP, SESSION)
+    zone_info = ctb2strava.get_zone_info(location)
+    return list(ctb2strava.iter_track_points(
+        location['latitude'],
+        location['longitude'],
+        datetime.fromisoformat(SESSION['time_start']).replace(tzinfo=zone_info).astimezone(timezone.utc),
+        datetime.fromisoformat(SESSION['time_end']).replace(tzinfo=zone_info).astimezone(timezone.utc),
+        ELEVATION,
+        [ctb2strava.get_route_height(route) for route in ctb2strava.get_routes(BACKUP, SESSION)]
+    ))
+
+def parse_gpx(text):
+    # Namespace and formatting independent content of a single track GPX
+    elements = {element.tag.rsplit('}', 1)[-1]: element for element in ElementTree.fromstring(text).iter()}
+    points = [
+        (
+            float(point.get('lat')),
+            float(point.get('lon')),
+            float(next(child for child in point if child.tag.endswith('ele')).text),
+            datetime.fromisoformat(next(child for child in point if child.tag.endswith('time')).text.replace('Z', '+00:00'))
+        )
+        for point in ElementTree.fromstring(text).iter()
+        if point.tag.endswith('trkpt')
+    ]
+    return {
+        'name': elements['name'].text,
+        'desc': elements['desc'].text,
+        'type': elements['type'].text if 'type' in elements else None,
+        'points': points
+    }
+
+def parse_multipart(content_type, body):
+    message = BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+    return {
+        part.get_param('name', header='content-disposition'): (part.get_filename(), part.get_payload(decode=True))
+        for part in message.get_payload()
+    }
+
+def test_write_gpx():
+    gpx = parse_gpx(ctb2strava.get_gpx(BACKUP, SESSION, engine='python'))
+    location = ctb2strava.get_location(BACKUP, SESSION)
+    assert gpx['name'] == ctb2strava.get_title(location)
+    assert gpx['desc'] == ctb2strava.get_description(SESSION, ctb2strava.get_routes(BACKUP, SESSION))
+    assert gpx['type'] == 'RockClimbing'
+    assert gpx['points'] == get_track_points()
+
+@pytest.mark.parametrize('engine', list(ctb2strava.TRACK_ENGINES))
+def test_track_engines(engine):
+    assert ctb2strava.get_gpx(BACKUP, SESSION, engine=engine) == ctb2strava.get_gpx(BACKUP, SESSION, engine='python')
+
+def load_reference(path):
+    if not os.path.exists(path):
+        pytest.skip(f"{os.path.basename(path)} missing, run tests/make_gpx2strava_fixtures.py with gpx2strava 2.0.0 installed")
+    with open(path, encoding='utf-8') as file:
+        return file.read()
+
+def test_write_gpx_matches_gpx2strava():
+    gpx = parse_gpx(ctb2strava.get_gpx(BACKUP, SESSION, engine='python'))
+    reference = parse_gpx(load_reference(REFERENCE_GPX))
+    assert gpx['name'] == reference['name']
+    assert gpx['desc'] == reference['desc']
+    assert gpx['type'] == reference['type']
+    # Coordinates may be printed with fewer decimals, 1e-7 degrees is about a centimeter
+    assert [value for point in gpx['points'] for value in point[:2]] == pytest.approx([value for point in reference['points'] for value in point[:2]], abs=1e-7)
+    assert [point[2:] for point in gpx['points']] == [point[2:] for point in reference['points']]
+
+def upload(monkeypatch, compress_level):
+    requests = []
+
+    class Response:
+        status_code = 201
+        headers = {}
+
+    def http_request(method, url, **kwargs):
+        requests.append((method, url, kwargs['headers'], kwargs['data'].read()))
+        return Response()
+
+    monkeypatch.setattr(ctb2strava, 'http_request', http_request)
+    with ctb2strava.get_gpx_file(BACKUP, SESSION, compress_level, engine='python') as gpx:
+        ctb2strava.upload_to_strava('token', ctb2strava.RateLimiter('test'), gpx, 'gpx.gz' if compress_level else 'gpx')
+    method, url, headers, body = requests[0]
+    return method, url, headers['Authorization'], parse_multipart(headers['Content-Type'], body)
+
+def test_upload_to_strava(monkeypatch):
+    gpx = ctb2strava.get_gpx(BACKUP, SESSION, engine='python').encode()
+    assert upload(monkeypatch, 0) == ('POST', 'https://www.strava.com/api/v3/uploads', 'Bearer token', {
+        'data_type': (None, b'gpx'),
+        'file': ('activity.gpx', gpx)
+    })
+    method, url, authorization, fields = upload(monkeypatch, 6)
+    assert fields['data_type'] == (None, b'gpx.gz')
+    assert fields['file'][0] == 'activity.gpx.gz'
+    assert gzip.decompress(fields['file'][1]) == gpx
+
+def test_upload_to_strava_matches_gpx2strava(monkeypatch):
+    reference = json.loads(load_reference(REFERENCE_UPLOAD))
+    method, url, authorization, fields = upload(monkeypatch, 0)
+    assert (method, url, authorization) == (reference['method'], reference['url'], reference['authorization'])
+    reference_fields = parse_multipart(reference['content_type'], base64.b64decode(reference['body']))
+    assert fields.keys() == reference_fields.keys()
+    assert fields['data_type'] == reference_fields['data_type']
+    assert fields['file'][1] == reference_fields['file'][1]
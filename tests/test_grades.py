@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ctb2strava
+
+
+@pytest.mark.parametrize('name, from_system, to_system, expected', [
+    ('6a', 'french', 'yds', '5.10a'),
+    ('6a', 'french', 'uiaa', '6+'),
+    ('V5', 'v-scale', 'fontainebleau', '6c'),
+    ('WI-3', 'wi-scale', 'wi-scale', 'WI-3')
+])
+def test_convert_grade(name, from_system, to_system, expected):
+    assert ctb2strava.convert_grade(name, from_system, to_system) == expected
+
+def test_convert_grade_backup_spelling():
+    assert ctb2strava.convert_grade('6a', 'French', 'YDS') == '5.10a'
+    assert ctb2strava.convert_grade('V5', 'V-Scale', 'Fontainebleau') == '6c'
+
+@pytest.mark.parametrize('name, from_system, to_system', [
+    ('6a', 'french', 'fontainebleau'),
+    ('V5', 'v-scale', 'french'),
+    ('WI-3', 'wi-scale', 'french'),
+    ('6d', 'french', 'yds'),
+    ('6a', 'ewbank', 'yds')
+])
+def test_convert_grade_invalid(name, from_system, to_system):
+    with pytest.raises(ValueError):
+        ctb2strava.convert_grade(name, from_system, to_system)
+
+@pytest.mark.parametrize('route_type, grade_id, original_grade_system, expected', [
+    ('SPORT_CLIMBING', 1000, None, '6a'),
+    ('SPORT_CLIMBING', 1000, 'YDS', '5.10a'),
+    # A grade system of another family falls back to the one of the route type
+    ('SPORT_CLIMBING', 1000, 'Fontainebleau', '6a'),
+    ('ICE_CLIMBING', 15, None, 'WI-3'),
+    ('BOULDER', 11400, 'V-Scale', 'V5'),
+    # Above the top and below the bottom grades
+    ('SPORT_CLIMBING', 3350, None, '9c'),
+    ('SPORT_CLIMBING', 99, None, '1'),
+    ('BOULDER', 14200, None, '9a'),
+    ('BOULDER', 9650, None, '1'),
+    ('ICE_CLIMBING', 45, None, 'WI-8'),
+    ('ICE_CLIMBING', 1, None, 'WI-1')
+])
+def test_route_grade_name(route_type, grade_id, original_grade_system, expected):
+    route = {'route_type': route_type, 'speed_type': 1, 'grade_id': grade_id, 'original_grade_system': original_grade_system}
+    assert ctb2strava.get_route_grade_name(route) == expected